@@ -149,11 +149,12 @@ class actuator(pl.LightningModule):
         mask = torch.ones(*anchors.shape[:-1]).to(device)
         pred_embed, _ = self.CG_all(anchors, all_context, mask)
 
-        prob_pred = (self.prob_head(pred_embed)).squeeze(-1)
+        # the heads are in float32 also under autocast, the trajectories are accumulated from their outputs
+        prob_pred = (self.prob_head(pred_embed)).float().squeeze(-1)
         # speed_pred = nn.ReLU()(self.speed_head(pred_embed)).view(b,6,self.pred_len)
-        velo_pred = self.velo_head(pred_embed).view(b, 6, self.pred_len, 2)
-        pos_pred = self.pos_head(pred_embed).view(b, 6, self.pred_len, 2).cumsum(-2)
-        heading_pred = self.angle_head(pred_embed).view(b, 6, self.pred_len).cumsum(-1)
+        velo_pred = self.velo_head(pred_embed).float().view(b, 6, self.pred_len, 2)
+        pos_pred = self.pos_head(pred_embed).float().view(b, 6, self.pred_len, 2).cumsum(-2)
+        heading_pred = self.angle_head(pred_embed).float().view(b, 6, self.pred_len).cumsum(-1)
 
         pred = {}
         pred['prob'] = prob_pred
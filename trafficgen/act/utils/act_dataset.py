@@ -1,6 +1,5 @@
 import copy
 import os
-import pickle
 
 import numpy as np
 import torch
@@ -8,7 +7,10 @@ from shapely.geometry import Polygon
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
+from trafficgen.utils.cache import ShardedCache
 from trafficgen.utils.config import load_config_act, get_parsed_args
+from trafficgen.utils.scenario_store import load_scenario
+from trafficgen.utils.utils import LaneIndex
 
 LANE_SAMPLE = 10
 RANGE = 60
@@ -246,31 +248,30 @@ class actDataset(Dataset):
         self.data_path = cfg['data_path']
         self.pred_len = cfg['pred_len']
         self.data_len = None
-        self.data_loaded = {}
         self.scene_data = {}
         self.cfg = cfg
         self.load_data()
 
     def load_data(self):
         print('loading data...')
-        if self.cfg['use_cache']:
-            data_path = os.path.join(self.data_path, 'act_cache.pkl')
-            with open(data_path, 'rb+') as f:
-                self.data_loaded = pickle.load(f)
-            self.data_len = len(self.data_loaded)
-        else:
-            for file_indx in tqdm(range(self.total_data_usage)):
-                data_file_path = os.path.join(self.data_path, f'{file_indx}.pkl')
-                with open(data_file_path, 'rb+') as f:
-                    datas = pickle.load(f)
-                    datas = self.process(datas)
-                    wash(datas)
-                self.data_loaded[file_indx] = datas
-            self.data_len = self.total_data_usage
-
-            data_path = os.path.join(self.data_path, 'act_cache.pkl')
-            with open(data_path, 'wb') as f:
-                pickle.dump(self.data_loaded, f)
+        # processed cases are cached in shards, use_cache reuses the shards built with the same config
+        self.cache = ShardedCache(
+            os.path.join(self.data_path, 'act_cache'), self.cfg, ['pred_len'],
+            shard_size=self.cfg.get('cache_shard_size', 16), max_shards=self.cfg.get('cache_max_shards', 4)
+        )
+        for shard in tqdm(self.cache.shards(self.total_data_usage)):
+            if self.cfg['use_cache'] and self.cache.exists(shard):
+                continue
+            case_list = []
+            for file_indx in range(*shard):
+                datas = load_scenario(self.data_path, file_indx)
+                datas = self.process(datas)
+                wash(datas)
+                case_list.append(datas)
+            self.cache.save(shard, case_list)
+
+        self.cache.open(self.total_data_usage)
+        self.data_len = len(self.cache)
 
     def __len__(self):
         # debug set length=478
@@ -280,7 +281,7 @@ class actDataset(Dataset):
         """
         Calculate for saving spaces
         """
-        return self.data_loaded[index]
+        return self.cache[index]
 
     def process_scene(self, data):
 
@@ -316,7 +317,8 @@ class actDataset(Dataset):
 
     def process_agent(self, data):
 
-        agent = data['all_agent']
+        # the loaded arrays may be read only
+        agent = np.array(data['all_agent'])
         ego = agent[:, 0]
 
         ego_pos = copy.deepcopy(ego[[0], :2])[:, np.newaxis]
@@ -356,34 +358,15 @@ class actDataset(Dataset):
 
         return agent_context, agent_mask, agent[:self.pred_len, 0]
 
-    def transform_coordinate_map(self, data):
-        """
-        Every frame is different
-        """
-        timestep = data['all_agent'].shape[0]
-
-        # sdc_theta = data['sdc_theta'][:,np.newaxis]
-        ego = data['all_agent'][:, 0]
-        pos = ego[:, [0, 1]][:, np.newaxis]
-
-        lane = data['lane'][np.newaxis]
-        lane = np.repeat(lane, timestep, axis=0)
-        lane[..., :2] -= pos
-
-        x = lane[..., 0]
-        y = lane[..., 1]
-        ego_heading = ego[:, [4]]
-        lane[..., :2] = rotate(x, y, -ego_heading)
-
-        data['lane'] = lane
-
     def process(self, data):
         case_info = {}
 
-        self.transform_coordinate_map(data)
+        # only the first frame is used, crop it with a spatial index instead of transforming the lane to every frame
+        lane_index = LaneIndex(data['lane'])
+        ego_pose = data['all_agent'][[0], 0][:, [0, 1, 4]]
         case_info['center'], case_info['center_mask'], case_info['bound'], case_info['bound_mask'], \
-        case_info['cross'], case_info['cross_mask'], case_info['rest'], case_info['rest_mask'] = process_map(
-            data['lane'][[0]], [data['traffic_light'][0]], center_num=256, edge_num=128, offest=-40, lane_range=60)
+        case_info['cross'], case_info['cross_mask'], case_info['rest'], case_info['rest_mask'] = lane_index.process_map(
+            ego_pose, [data['traffic_light'][0]], center_num=256, edge_num=128, offest=-40, lane_range=60)
 
         case_info['center'] = case_info['center'][0]
         case_info['center_mask'] = case_info['center_mask'][0]
@@ -16,10 +16,12 @@ if __name__ == "__main__":
 
     cfg = load_config_init(args.config)
 
-    if torch.cuda.is_available():
+    # the int8 models only run on cpu
+    if torch.cuda.is_available() and not cfg.get('quantized', False):
         cfg["device"] = "cuda"
 
-    print('loading checkpoint...')
+    # the checkpoints are loaded when the models are first used
+    print('loading data...')
     trafficgen = TrafficGen(cfg)
     print('Complete.\n')
 
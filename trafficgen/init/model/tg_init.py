@@ -1,18 +1,21 @@
 import copy
+import logging
 
 import torch
 import torch.nn as nn
 from torch import Tensor
 
-from trafficgen.init.utils.model_utils import MLP_3, CG_stacked
+from trafficgen.init.utils.model_utils import MLP_3, CG_stacked, GaussianMixture
+from trafficgen.utils.utils import box_intersect, point_in_box
 
 copy_func = copy.deepcopy
 from trafficgen.init.utils.init_dataset import WaymoAgent, get_agent_pos_from_vec
-from random import choices
 from torch.optim.lr_scheduler import MultiStepLR
 import numpy as np
 import pytorch_lightning as pl
 
+logger = logging.getLogger(__name__)
+
 
 class initializer(pl.LightningModule):
     """ A transformer model with wider latent space """
@@ -99,84 +102,126 @@ class initializer(pl.LightningModule):
     #         else:
     #             param.data.normal_(0, math.sqrt(2) / math.sqrt(param.shape[1]))
 
-    def sample_from_distribution(self, pred, center_lane, repeat_num=5):
-        prob = pred['prob'][0]
-        max_prob = 0
-
-        for i in range(2):
-            indx = choices(list(range(prob.shape[-1])), prob)[0]
-            vec_logprob_ = prob[indx]
-            if vec_logprob_ > max_prob:
-                the_indx = indx
-                max_prob = max(vec_logprob_, max_prob)
-
-        # idx_list = []
-        prob_list = []
-        agents_list = []
-        # pos = torch.clip(pred['pos'], min=-0.5, max=0.5)
-        speed = torch.clip(pred['speed'], min=0) ## 将 pred['speed'] 张量中的每个值与 0 比较，如果某个值小于 0，就将其替换为 0；如果大于或等于 0，则保持原值不变。
-        vel_heading = pred['vel_heading']
-        for i in range(repeat_num):
-            pos = torch.clip(pred['pos'].sample(), min=-0.5, max=0.5)
-            pos_logprob = pred['pos'].log_prob(pos)
-
-            heading = torch.clip(pred['heading'].sample(), min=-np.pi / 2, max=np.pi / 2)
-            heading_logprob = pred['heading'].log_prob(heading)
-
-            # vel_heading = torch.clip(pred['vel_heading'].sample(),min=-np.pi/2,max=np.pi/2)
-            # vel_heading_logprob = pred['vel_heading'].log_prob(vel_heading)
-
-            bbox = torch.clip(pred['bbox'].sample(), min=1.5)
-            bbox_logprob = pred['bbox'].log_prob(bbox)
-
-            # speed = torch.clip(pred['speed'].sample(),min=0)
-            # speed_logprob = pred['speed'].log_prob(speed)
-
-            agents = get_agent_pos_from_vec(center_lane, pos[0], speed[0], vel_heading[0], heading[0], bbox[0])
-            agents_list.append(agents)
-            pos_logprob_ = pos_logprob[0, the_indx]
-            heading_logprob_ = heading_logprob[0, the_indx]
-            # vel_heading_logprob_ = vel_heading_logprob[0,the_indx]
-            bbox_logprob_ = bbox_logprob[0, the_indx]
-            # speed_logprob_ = speed_logprob[0,the_indx]
-            all_prob = heading_logprob_ + bbox_logprob_ + pos_logprob_
-            prob_list.append(all_prob)
-
-        # max_indx = np.argmax(prob_list)
-        max_indx = torch.stack(prob_list).argmax().item()
-        max_agents = agents_list[max_indx]
-        return max_agents, prob, the_indx
-
-    def output_to_dist(self, para, n):
-        # if n = 2, dim = 5 = 2 + 3, if n = 1, dim = 2 = 1 + 1
-
-        if n == 2:
-            loc, tril, diag = para[..., :2], para[..., 2], para[..., 3:]
-
-            sigma_1 = torch.exp(diag[..., 0]) ## 训练模型时经常使用对数尺度来更好地拟合数据，并且防止标准差变得过小或过大。使用 torch.exp（指数函数）将对数标准差转换为标准差。
-            sigma_2 = torch.exp(diag[..., 1])
-            rho = torch.tanh(tril)  ## rho为两个维度之间的相关系数，要在[-1,1]之间，使用tanh()正好可以满足要求
-
-            cov = torch.stack([sigma_1**2, rho * sigma_1 * sigma_2, rho * sigma_1 * sigma_2, sigma_2**2],
-                              dim=-1).view(*loc.shape[:-1], 2, 2)
-
-            distri = torch.distributions.multivariate_normal.MultivariateNormal(loc=loc, covariance_matrix=cov)
-
-            return distri
-
-        if n == 1:
-            loc, scale = para[..., 0], para[..., 1]
-            scale = torch.exp(scale)
-            distri = torch.distributions.Normal(loc, scale)
-
-            return distri
+    def sample_candidates(self, pred, rows, indx, repeat_num):
+        """
+        Draw repeat_num candidates on the vectors indx of the rows, in shape [repeat_num, len(rows)], with the summed
+        log probability of their position, heading and bounding box.
+        """
+        pos_dist = pred['pos'].select(rows, indx)
+        pos = torch.clip(pos_dist.sample((repeat_num, )), min=-0.5, max=0.5)
+        pos_logprob = pos_dist.log_prob(pos)
+
+        heading_dist = pred['heading'].select(rows, indx)
+        heading = torch.clip(heading_dist.sample((repeat_num, )), min=-np.pi / 2, max=np.pi / 2)
+        heading_logprob = heading_dist.log_prob(heading)
+
+        bbox_dist = pred['bbox'].select(rows, indx)
+        bbox = torch.clip(bbox_dist.sample((repeat_num, )), min=1.5)
+        bbox_logprob = bbox_dist.log_prob(bbox)
+
+        return pos, heading, bbox, heading_logprob + bbox_logprob + pos_logprob
+
+    def sample_from_distribution(self, pred, center_lane, repeat_num=5, rows=None):
+        """
+        Sample one agent for each of the rows of the batch (all of them by default). The lane vector is the more likely
+        of two vectors drawn by their probability, then repeat_num candidates are drawn on it and the one with the
+        highest log probability is kept. Only the agent of that candidate is built.
+        Returns the agent, the probability and the picked vector index of every row.
+        """
+        prob = pred['prob']
+        if rows is None:
+            rows = list(range(prob.shape[0]))
+        rows = torch.tensor(rows, device=prob.device)
+
+        # keep the first of the two draws unless the second one is strictly more likely
+        draws = torch.multinomial(prob[rows], 2, replacement=True)
+        draw_prob = prob[rows.unsqueeze(-1), draws]
+        indx = torch.where(draw_prob[:, 1] > draw_prob[:, 0], draws[:, 1], draws[:, 0])
+
+        pos, heading, bbox, logprob = self.sample_candidates(pred, rows, indx, repeat_num)
+        best = logprob.argmax(0)
+        candidate = torch.arange(rows.shape[0], device=prob.device)
+
+        speed = torch.clip(pred['speed'][rows, indx], min=0) ## 将速度中小于 0 的值替换为 0
+        vel_heading = pred['vel_heading'][rows, indx]
+        agents = get_agent_pos_from_vec(
+            center_lane[rows, indx], pos[best, candidate], speed, vel_heading, heading[best, candidate],
+            bbox[best, candidate]
+        )
+
+        indx = indx.tolist()
+        return [agents.get_agent(j) for j in range(len(indx))], [prob[b] for b in rows], indx
+
+    def sample_free_space(self, pred, center_lane, boxes, repeat_num=5, vec_num=8):
+        """
+        Sample one agent for every row of the batch that does not overlap the placed agents, boxes holds their corners
+        for every row. Lane vectors whose center is covered by a placed agent get probability 0, then vec_num vectors
+        are drawn by their probability with repeat_num candidates on each. Candidates that overlap a placed agent are
+        discarded. The drawn vectors already follow the probability, so one of those with a valid candidate is picked
+        uniformly and its most likely valid candidate is built.
+        Returns the agent and the picked vector index of every row, both None if no candidate is valid.
+        """
+        prob = pred['prob'].clone()
+        b = prob.shape[0]
+        center = center_lane.cpu().numpy()
+        vec_center = (center[..., 0:2] + center[..., 2:4]) / 2
+        for r in range(b):
+            if boxes[r].shape[0] > 0:
+                covered = point_in_box(vec_center[r], boxes[r]).any(1)
+                prob[r, torch.from_numpy(covered).to(prob.device)] = 0
+
+        valid_row = prob.sum(-1) > 0
+        prob[~valid_row] = 1  # rows without free vector draw anything, their candidates are all discarded below
+        indx = torch.multinomial(prob, vec_num, replacement=True)  # [b, vec_num]
+        rows = torch.arange(b, device=prob.device).unsqueeze(-1).repeat(1, vec_num)
+        vec_prob = prob[rows, indx].masked_fill(~valid_row.unsqueeze(-1), 0)
+
+        rows, indx = rows.flatten(), indx.flatten()
+        pos, heading, bbox, logprob = self.sample_candidates(pred, rows, indx, repeat_num)
+
+        # the boxes of all candidates, in shape [repeat_num, b * vec_num, 4, 2]
+        speed = torch.clip(pred['speed'][rows, indx], min=0)
+        candidates = get_agent_pos_from_vec(
+            center_lane[rows, indx].repeat(repeat_num, 1), pos.flatten(0, 1), speed.repeat(repeat_num),
+            pred['vel_heading'][rows, indx].repeat(repeat_num), heading.flatten(), bbox.flatten(0, 1)
+        )
+        cand_boxes = np.stack(candidates.get_rect(pad=0.25)).reshape(repeat_num, b, vec_num, 4, 2)
+        vec_prob = vec_prob.cpu().numpy()
+        logprob = logprob.view(repeat_num, b, vec_num).cpu().numpy()
+        indx = indx.view(b, vec_num).tolist()
+
+        agents = []
+        the_indx = []
+        for r in range(b):
+            valid = vec_prob[r] > 0
+            if boxes[r].shape[0] > 0:
+                overlap = box_intersect(cand_boxes[:, r].reshape(-1, 4, 2), boxes[r]).any(1)
+                valid = valid & ~overlap.reshape(repeat_num, vec_num)
+            else:
+                valid = np.broadcast_to(valid, [repeat_num, vec_num])
+            if not valid.any():
+                agents.append(None)
+                the_indx.append(None)
+                continue
+            # a drawn vector with a valid candidate, weighting it by its probability again would sharpen the draw
+            v = np.random.choice(np.flatnonzero(valid.any(0)))
+            k = np.argmax(np.where(valid[:, v], logprob[:, r, v], -np.inf))
+            agents.append(candidates.get_agent((k * b + r) * vec_num + v))
+            the_indx.append(indx[r][v])
+        return agents, the_indx
 
     def feature_to_dists(self, feature):
+        return self.outputs_to_dists(*self.head_outputs(feature))
 
+    def head_outputs(self, feature):
+        """
+        The raw outputs of the heads, in float32 also under autocast: the vector logit, the mixture outputs of
+        position, bounding box and heading in shape [*, K, -1], the speed and the velocity heading.
+        """
         # feature dim (batch,128,2048)
         # vector distribution
         K = self.K
-        prob_pred = self.prob_head(feature).squeeze(-1)
+        prob_pred = self.prob_head(feature).float().squeeze(-1)
 
         # position distribution： 2 dimension x y, range(-1/2,1/2)
         # pos_out dim (batch,128,10,6),
@@ -184,52 +229,48 @@ class initializer(pl.LightningModule):
         # 0: mixture weight
         # 1-2: mean
         # 3-5: variance and covariance
-        # pos_out = self.pos_head(feature)
-        speed_out = nn.ReLU()(self.speed_head(feature))
-        vel_heading_out = self.vel_heading_head(feature)
-
-        pos_out = self.pos_head(feature).view([*feature.shape[:-1], K, -1])
-        pos_weight = pos_out[..., 0]
-        pos_param = pos_out[..., 1:]
-        pos_distri = self.output_to_dist(pos_param, 2)
-        pos_weight = torch.distributions.Categorical(logits=pos_weight)
-        pos_gmm = torch.distributions.mixture_same_family.MixtureSameFamily(pos_weight, pos_distri)
+        # the mixtures are computed from the float32 outputs
+        pos_out = self.pos_head(feature).float().view([*feature.shape[:-1], K, -1])
 
         # bbox distribution： 2 dimension length width
-        bbox_out = self.bbox_head(feature).view([*feature.shape[:-1], K, -1])
-        bbox_weight = bbox_out[..., 0]
-        bbox_param = bbox_out[..., 1:]
-        bbox_distri = self.output_to_dist(bbox_param, 2)
-        bbox_weight = torch.distributions.Categorical(logits=bbox_weight)
-        bbox_gmm = torch.distributions.mixture_same_family.MixtureSameFamily(bbox_weight, bbox_distri)
+        bbox_out = self.bbox_head(feature).float().view([*feature.shape[:-1], K, -1])
 
         # heading distribution: 1 dimension,range(-pi/2,pi/2)
-        heading_out = self.heading_head(feature).view([*feature.shape[:-1], K, -1])
-        heading_weight = heading_out[..., 0]
-        heading_param = heading_out[..., 1:]
-        heading_distri = self.output_to_dist(heading_param, 1)
-        heading_weight = torch.distributions.Categorical(logits=heading_weight)
-        heading_gmm = torch.distributions.mixture_same_family.MixtureSameFamily(heading_weight, heading_distri)
+        heading_out = self.heading_head(feature).float().view([*feature.shape[:-1], K, -1])
 
         # speed distribution: 1 dimension
         # vel heading distribution: 1 dimension,range(-pi/2,pi/2)
-        # vel_heading_out = self.vel_heading_head(feature).view([*feature.shape[:-1], K, -1])
-        # vel_heading_weight = vel_heading_out[..., 0]
-        # vel_heading_param = vel_heading_out[..., 1:]
-        # vel_heading_distri = self.output_to_dist(vel_heading_param, 1)
-        # vel_heading_weight = torch.distributions.Categorical(logits=vel_heading_weight)
-        # vel_heading_gmm = torch.distributions.mixture_same_family.MixtureSameFamily(vel_heading_weight,
-        #                                                                             vel_heading_distri)
+        speed_out = nn.ReLU()(self.speed_head(feature).float()).squeeze(-1)
+        vel_heading_out = self.vel_heading_head(feature).float().squeeze(-1)
+        return prob_pred, pos_out, bbox_out, heading_out, speed_out, vel_heading_out
+
+    @staticmethod
+    def outputs_to_dists(prob_pred, pos_out, bbox_out, heading_out, speed_out, vel_heading_out):
         return {
             'prob': prob_pred,
-            'pos': pos_gmm,
-            'bbox': bbox_gmm,
-            'heading': heading_gmm,
-            'speed': speed_out.squeeze(-1),
-            'vel_heading': vel_heading_out.squeeze(-1)
+            'pos': GaussianMixture(pos_out, 2),
+            'bbox': GaussianMixture(bbox_out, 2),
+            'heading': GaussianMixture(heading_out, 1),
+            'speed': speed_out,
+            'vel_heading': vel_heading_out
         }
 
     def agent_feature_extract(self, agent_feat, agent_mask, random_mask):
+        min_agent_num = self.cfg['min_agent']
+        if random_mask:
+            agent_mask[:, 0] = 1
+            for i in range(agent_mask.shape[0]):
+                masked_num = i % min_agent_num
+                agent_mask[i, 1 + masked_num:] = 0
+
+        agent_enc = self.encode_agent(agent_feat)
+        return self.agent_context(agent_enc, agent_mask)
+
+    def encode_agent(self, agent_feat):
+        """
+        The encoding of every agent on its own: the agent MLP with the lane type and traffic light embeddings, followed
+        by the MLP of the first CG block, whose context is all ones. It does not change when other agents are added.
+        """
         agent = agent_feat[..., :-2]
         agent_line_type = agent_feat[..., -2].to(int)
         agent_line_traf = agent_feat[..., -1].to(int)
@@ -238,24 +279,30 @@ class initializer(pl.LightningModule):
         agent_line_type_embed = self.type_embedding(agent_line_type)
         agent_line_traf_embed = self.traf_embedding(agent_line_traf)
 
-        min_agent_num = self.cfg['min_agent']
-        if random_mask:
-            agent_mask[:, 0] = 1
-            for i in range(agent_mask.shape[0]):
-                masked_num = i % min_agent_num
-                agent_mask[i, 1 + masked_num:] = 0
-
         agent_enc = self.agent_encode(agent) + agent_line_type_embed + agent_line_traf_embed
+        return self.CG_agent.CGs[0].MLP(agent_enc)
+
+    def agent_context(self, agent_enc, agent_mask):
+        """
+        The context of the agents encoded by encode_agent, from the CG blocks. Only the MLP of the first block is
+        cached in agent_enc. Every later block multiplies the output of all the agents by the context of the block
+        before, so when an agent is added the context changes and blocks 2 to 5 have to run over all the agents again.
+        The max of the first block could be kept as a running max, but that saves only a max over the agents, so the
+        cost of a call stays linear in the number of agents.
+        """
         b, a, d = agent_enc.shape
 
-        context_agent = torch.ones([b, d], device=agent_feat.device)
+        context_agent = torch.ones([b, d], device=agent_enc.device)
         # agent information fusion with CG block
-        agent_enc, context_agent = self.CG_agent(agent_enc, context_agent, agent_mask)
+        agent_enc, context_agent = self.CG_agent(agent_enc, context_agent, agent_mask, encoded=True)
 
         return context_agent
 
-    def map_feature_extract(self, lane_inp, line_mask, context_agent):
-
+    def encode_lane(self, lane_inp):
+        """
+        The part of the lane encoding that does not depend on the agents: the lane MLP with the type and traffic light
+        embeddings, followed by the MLP of the first CG block. It only has to be computed once per scenario.
+        """
         polyline = lane_inp[..., :4]
         polyline_type = lane_inp[..., 4].to(int)
         polyline_traf = lane_inp[..., 5].to(int)
@@ -267,8 +314,14 @@ class initializer(pl.LightningModule):
 
         # agent features
         line_enc = self.line_encode(polyline) + polyline_traf_embed + polyline_type_embed
+        return self.CG_line.CGs[0].MLP(line_enc)
+
+    def map_feature_extract(self, lane_inp, line_mask, context_agent, lane_enc=None):
+        if lane_enc is None:
+            lane_enc = self.encode_lane(lane_inp)
+
         # map information fusion with CG block
-        line_enc, context_line = self.CG_line(line_enc, context_agent, line_mask)
+        line_enc, context_line = self.CG_line(lane_enc, context_agent, line_mask, encoded=True)
         # map context feature
         context_line = context_line.unsqueeze(1).repeat(1, line_enc.shape[1], 1)
         feature = torch.cat([line_enc, context_line], dim=-1)
@@ -324,69 +377,113 @@ class initializer(pl.LightningModule):
         return losses, total_loss
 
     def inference(self, data, context_num=1):
-
-        agent_num = data['agent_mask'].sum().item()
-        idx_list = []
-        pred_list = []
-        heat_maps = []
-        prob_list = []
-        shapes = []
-
-        for i in range(context_num):
-            context_agent = data['agent'][0, [i]].cpu().numpy()
-            context_agent = WaymoAgent(context_agent)
-            context_poly = context_agent.get_polygon()[0] ## 存放了context_agent的顶点位置坐标
-            shapes.append(context_poly)
-            pred_list.append(context_agent)
-            vec_indx = data['vec_based_rep'][..., 0]
-            idx_list.append(vec_indx[0, i].item())
-
-        minimum_agent = self.cfg['pad_num']
-        center = data['center'][0]
-        center_mask = data['center_mask'][0].cpu().numpy()
-
-        for i in range(context_num, max(2, minimum_agent)):
-            data['agent_mask'][:, :i] = 1  ## 迭代进行的，所以，前i个已经被确定了，故agent_mask=0
-            data['agent_mask'][:, i:] = 0
-
-            pred = self.forward(data, False)
-
-            pred['prob'][:, idx_list] = 0  ## idx_list中存放的是哪些已经被选中的agent，即他们不在变化的范围之内，而设置对应的pred=0表明该路段已被agent占用，就不要再在这个Lane上放置agent了
+        return self.inference_batch(data, context_num)[0]
+
+    def inference_batch(self, data, context_num=1, agent_num=None, occupancy=False):
+        """
+        Place agents in the b scenarios of the batch at the same time, each placement step runs one forward pass for
+        all the scenarios that still need agents. The lanes are only encoded once and every agent is encoded once when
+        it is placed, only the CG blocks of the agent context run again at every step, over the placed agents. The
+        context of the placed agents cannot be updated incrementally (see agent_context), so placing n agents still
+        costs O(n^2) in the agent context, next to n forward passes of the lanes, which dominate for the usual n.
+        agent_num is the number of agents to place in every scenario, cfg['pad_num'] by default.
+        With occupancy, agents are sampled with sample_free_space and never overlap, a scenario stops early when no
+        valid placement is found, with a warning, and its output has fewer agents than requested. Otherwise an
+        overlapping agent is sampled again up to 3 times and then kept.
+        The batch is not modified.
+        Returns a list with the output of every scenario.
+        """
+        b = data['agent_mask'].shape[0]
+        device = data['agent_feat'].device
+        if agent_num is None:
+            agent_num = [self.cfg['pad_num']] * b
+        agent_num = torch.tensor([max(2, n) for n in agent_num], device=device)
+
+        center = data['center']
+        agent_feat = data['agent_feat'].clone()
+        occupied = torch.zeros(center.shape[:2], dtype=torch.bool, device=device)  ## 已被agent占用的车道
+        lane_enc = self.encode_lane(data['lane_inp'])  ## 地图在放置过程中不变，只编码一次
+        agent_enc = self.encode_agent(agent_feat)  ## 每个agent单独的编码，放置新的agent时只需要编码新的agent
+        pred_list = [[] for _ in range(b)]
+        prob_list = [[] for _ in range(b)]
+        boxes = [np.zeros([0, 4, 2]) for _ in range(b)]  ## 已放置的agent四个角的坐标
+
+        vec_indx = data['vec_based_rep'][..., 0].long()
+        for s in range(b):
+            for i in range(context_num):
+                context_agent = data['agent'][s, [i]].cpu().numpy()
+                context_agent = WaymoAgent(context_agent)
+                boxes[s] = np.concatenate([boxes[s], np.stack(context_agent.get_rect(pad=0.25))])
+                pred_list[s].append(context_agent)
+                occupied[s, vec_indx[s, i]] = True
+
+        for i in range(context_num, agent_num.max().item()):
+            active = torch.nonzero(agent_num > i)[:, 0]  ## 还需要放置agent的场景
+            if active.numel() == 0:  ## 所有场景都提前停止了
+                break
+            ## 迭代进行的，所以，前i个已经被确定了，context只由前i个agent得到
+            agent_inp = agent_enc[active, :i]
+            agent_mask = torch.ones(agent_inp.shape[:2], dtype=torch.bool, device=device)
+            context_agent = self.agent_context(agent_inp, agent_mask)
+            inp = {
+                'lane_inp': data['lane_inp'][active],
+                'lane_mask': data['lane_mask'][active],
+                'center': center[active]
+            }
+            pred = self.forward(inp, False, lane_enc[active], context_agent)
+
+            pred['prob'][occupied[active]] = 0  ## 已被agent占用的车道设置pred=0，就不要再在这个Lane上放置agent了
+
+            active = active.tolist()
+            the_agents = [None] * len(active)
+            the_indx = [None] * len(active)
+            rows = list(range(len(active)))
             cnt = 0
-            while cnt < 3:  ## 重复三次，提高命中概率（成功放置合理的agent）
-                agents, prob, indx = self.sample_from_distribution(pred, center)
-                the_agent = agents.get_agent(indx)  ## 生成的新的agent
-                poly = the_agent.get_polygon()[0]
-                intersect = False
-                for shape in shapes:  ## 查看新的agent和之前的一些已经被放置的agent是否重叠
-                    if poly.intersects(shape):
-                        intersect = True
-                        break
-                if not intersect:
-                    shapes.append(poly)
-                    break
-                else:
-                    cnt += 1
+            if occupancy:
+                the_agents, the_indx = self.sample_free_space(pred, inp['center'], [boxes[s] for s in active])
+                for r, s in enumerate(active):
+                    if the_agents[r] is not None:
+                        boxes[s] = np.concatenate([boxes[s], np.stack(the_agents[r].get_rect(pad=0.25))])
+                rows = []
+            while rows and cnt < 3:  ## 重复三次，提高命中概率（成功放置合理的agent）
+                agents, prob, indx = self.sample_from_distribution(pred, inp['center'], rows=rows)
+                retry = []
+                for j, r in enumerate(rows):
+                    the_agent = agents[j]  ## 生成的新的agent
+                    the_agents[r] = the_agent
+                    the_indx[r] = indx[j]
+                    box = np.stack(the_agent.get_rect(pad=0.25))
+                    s = active[r]
+                    if box_intersect(box, boxes[s]).any():  ## 查看新的agent和之前的一些已经被放置的agent是否重叠
+                        retry.append(r)
+                    else:
+                        boxes[s] = np.concatenate([boxes[s], box])
+                rows = retry
+                cnt += 1
+
+            for r, s in enumerate(active):
+                if the_agents[r] is None:  ## 没有不重叠的位置，这个场景停止放置
+                    logger.warning(
+                        'No free space in scenario %d of the batch, placed %d of %d agents', s, i, agent_num[s].item()
+                    )
+                    agent_num[s] = i
                     continue
-
-            pred_list.append(the_agent)
-            data['agent_feat'][:, i] = Tensor(the_agent.get_inp())
-            idx_list.append(indx)
-
-            # heat_maps.append(get_heatmap(agents.position[:,0][center_mask], agents.position[:, 1][center_mask],prob[center_mask].cpu().numpy(), 20))
-            prob_list.append(prob)
-
-        output = {}
-        output['agent'] = pred_list
-        output['prob'] = prob_list
-        # output['heat_maps'] = heat_maps
-
+                pred_list[s].append(the_agents[r])
+                agent_feat[s, i] = Tensor(the_agents[r].get_inp()[0])
+                occupied[s, the_indx[r]] = True
+                prob_list[s].append(pred['prob'][r])
+            agent_enc[active, i] = self.encode_agent(agent_feat[active, i:i + 1])[:, 0]
+
+        output = []
+        for s in range(b):
+            output.append({'agent': pred_list[s], 'prob': prob_list[s]})
         return output
 
-    def forward(self, data, random_mask=True):
+    def forward(self, data, random_mask=True, lane_enc=None, context_agent=None):
 
-        context_agent = self.agent_feature_extract(data['agent_feat'], data['agent_mask'], random_mask)
-        feature = self.map_feature_extract(data['lane_inp'], data['lane_mask'], context_agent)
+        if context_agent is None:
+            context_agent = self.agent_feature_extract(data['agent_feat'], data['agent_mask'], random_mask)
+        feature = self.map_feature_extract(data['lane_inp'], data['lane_mask'], context_agent, lane_enc)
         center_num = data['center'].shape[1]
         feature = feature[:, :center_num]
         # Sample location, bounding box, heading and velocity.
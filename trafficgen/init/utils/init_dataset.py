@@ -1,16 +1,17 @@
 import copy
+import multiprocessing
 import os
-import pickle
 
 import numpy as np
 import torch
-from shapely.geometry import Polygon
 from torch import Tensor
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
+from trafficgen.utils.cache import ShardedCache
 from trafficgen.utils.config import load_config_init, get_parsed_args
-from trafficgen.utils.utils import cal_rel_dir, rotate, process_map, wash
+from trafficgen.utils.scenario_store import load_scenario
+from trafficgen.utils.utils import cal_rel_dir, rotate, wash, LaneIndex, nearest_vec, compact, raster_sort
 
 
 def get_agent_pos_from_vec(vec, long_lat, speed, vel_heading, heading, bbox):
@@ -71,12 +72,13 @@ def get_gt(case_info):
     gt_distribution = np.zeros([b, lane_num])
     gt_vec_based_coord = np.zeros([b, lane_num, 5])
     gt_bbox = np.zeros([b, lane_num, 2])
-    for i in range(b):
-        mask = case_info['agent_mask'][i].sum()
-        indx = agent_vec_indx[i].astype(int)
-        gt_distribution[i][indx[:mask]] = 1
-        gt_vec_based_coord[i, indx] = vec_based_rep[i, :, :5]
-        gt_bbox[i, indx] = bbox[i]
+    # scatter all timesteps at once, for agents on the same vector the later one is kept
+    batch_index = np.arange(b)[:, np.newaxis]
+    index = agent_vec_indx.astype(int)
+    agent_mask = case_info['agent_mask']
+    gt_distribution[np.nonzero(agent_mask)[0], index[agent_mask]] = 1
+    gt_vec_based_coord[batch_index, index] = vec_based_rep[..., :5]
+    gt_bbox[batch_index, index] = bbox
     case_info['gt_bbox'] = gt_bbox
     case_info['gt_distribution'] = gt_distribution
     case_info['gt_long_lat'] = gt_vec_based_coord[..., :2]
@@ -113,27 +115,8 @@ def get_vec_rep(case_info):
 
     agent_mask = case_info['agent_mask']
 
-    vec_x = ((vectors[..., 0] + vectors[..., 2]) / 2)
-    vec_y = ((vectors[..., 1] + vectors[..., 3]) / 2)
-
-    agent_x = agent[..., 0]
-    agent_y = agent[..., 1]
-
-    b, vec_num = vec_y.shape
-    _, agent_num = agent_x.shape
-
-    vec_x = np.repeat(vec_x[:, np.newaxis], axis=1, repeats=agent_num)
-    vec_y = np.repeat(vec_y[:, np.newaxis], axis=1, repeats=agent_num)
-
-    agent_x = np.repeat(agent_x[:, :, np.newaxis], axis=-1, repeats=vec_num)
-    agent_y = np.repeat(agent_y[:, :, np.newaxis], axis=-1, repeats=vec_num)
-
-    dist = np.sqrt((vec_x - agent_x) ** 2 + (vec_y - agent_y) ** 2)
-
-    cent_mask = np.repeat(case_info['center_mask'][:, np.newaxis], axis=1, repeats=agent_num)
-    dist[cent_mask == 0] = 10e5
-    vec_index = np.argmin(dist, -1)
-    min_dist_to_lane = np.min(dist, -1)
+    # nearest center lane vector of every agent
+    vec_index, min_dist_to_lane = nearest_vec(agent[..., :2], vectors, case_info['center_mask'])
     min_dist_mask = min_dist_to_lane < thres
 
     selected_vec = np.take_along_axis(vectors, vec_index[..., np.newaxis], axis=1)
@@ -174,10 +157,6 @@ def get_vec_rep(case_info):
     total_mask[:, 0] = 1
     total_mask = total_mask.astype(bool)
 
-    b_s, agent_num, agent_dim = agent.shape
-    agent_ = np.zeros([b_s, max_agent_num, agent_dim])
-    agent_mask_ = np.zeros([b_s, max_agent_num]).astype(bool)
-
     the_vec = np.take_along_axis(vectors, vec_index[..., np.newaxis], 1)
     # 0: vec_index
     # 1-2 long and lat percent
@@ -191,22 +170,8 @@ def get_vec_rep(case_info):
         ], -1
     )
 
-    info_ = np.zeros([b_s, max_agent_num, info.shape[-1]])
-
-    for i in range(agent.shape[0]):
-        agent_i = agent[i][total_mask[i]]
-        info_i = info[i][total_mask[i]]
-
-        agent_i = agent_i[:max_agent_num]
-        info_i = info_i[:max_agent_num]
-
-        valid_num = agent_i.shape[0]
-        agent_i = np.pad(agent_i, [[0, max_agent_num - agent_i.shape[0]], [0, 0]])
-        info_i = np.pad(info_i, [[0, max_agent_num - info_i.shape[0]], [0, 0]])
-
-        agent_[i] = agent_i
-        info_[i] = info_i
-        agent_mask_[i, :valid_num] = True
+    # move the valid agents to the front and keep the first max_agent_num of them
+    (agent_, info_), agent_mask_ = compact(total_mask, max_agent_num, agent, info)
 
     # case_info['vec_index'] = info[...,0].astype(int)
     # case_info['relative_dir'] = info[..., 1]
@@ -223,7 +188,7 @@ def get_vec_rep(case_info):
     return
 
 
-def process_agent(agent, RANGE=50, sort_agent=True):
+def process_agent(agent, RANGE=50, sort_agent=True, rng=np.random):
     ego = agent[:, 0]
 
     ego_pos = copy.deepcopy(ego[:, :2])[:, np.newaxis]
@@ -239,33 +204,12 @@ def process_agent(agent, RANGE=50, sort_agent=True):
     agent_range_mask = (abs(agent[..., 0]) < RANGE) * (abs(agent[..., 1]) < RANGE)  ## 在范围RANGE内是否可见
     mask = agent_mask * agent_type_mask * agent_range_mask
 
-    bs, agent_num, _ = agent.shape
     sorted_agent = np.zeros_like(agent)
     sorted_mask = np.zeros_like(agent_mask).astype(bool)
     sorted_agent[:, 0] = agent[:, 0]  ## 将ego_agent的信息添加进来
     sorted_mask[:, 0] = True  ## ego_agent总是可见的
-    for i in range(bs):  ## bs代表总共几个时间步/帧，这里是10
-        xy = copy.deepcopy(agent[i, 1:, :2])  ## 注意，此时agent内存放的信息已经转为相对位置/速度/偏向角
-        agent_i = copy.deepcopy(agent[i, 1:])
-        mask_i = mask[i, 1:]
-
-        # put invalid agent to the right down side
-        xy[mask_i == False, 0] = 10e8
-        xy[mask_i == False, 1] = -10e8
-
-        raster = np.floor(xy / 0.25)
-        raster = np.concatenate([raster, agent_i, mask_i[:, np.newaxis]], -1)
-        y_index = np.argsort(-raster[:, 1]) ## 使用np.argsort()获取排序后的索引
-        raster = raster[y_index] ## 对raster进行排序，排序后，那些无法被观察的对象会被放在最后
-        y_set = np.unique(raster[:, 1])[::-1]
-        for y in y_set:  ##  前面按照raster[:,1]进行了排序,下面对于raster[:1]相同的元素按照raster[:0]再进行局部排序
-            ind = np.argwhere(raster[:, 1] == y)[:, 0]  ## np.argwhere()返回符合raster[:, 1] == y的元素坐标，如[0,1]，表示第一行第二列那个元素的值等于y
-            ys = raster[ind]
-            x_index = np.argsort(ys[:, 0])
-            raster[ind] = ys[x_index]
-        # scene = np.delete(raster, [0, 1], axis=-1)
-        sorted_agent[i, 1:] = raster[..., 2:-1]
-        sorted_mask[i, 1:] = raster[..., -1]
+    ## 注意，此时agent内存放的信息已经转为相对位置/速度/偏向角，所有帧一起排序，无法被观察的对象会被放在最后
+    sorted_agent[:, 1:], sorted_mask[:, 1:] = raster_sort(agent[:, 1:], mask[:, 1:])
 
     if sort_agent:
         return sorted_agent[..., :-1], sorted_mask
@@ -273,7 +217,7 @@ def process_agent(agent, RANGE=50, sort_agent=True):
         agent_nums = np.sum(sorted_mask, axis=-1)
         for i in range(sorted_agent.shape[0]):
             agent_num = int(agent_nums[i])
-            permut_idx = np.random.permutation(np.arange(1, agent_num)) - 1
+            permut_idx = rng.permutation(np.arange(1, agent_num)) - 1
             sorted_agent[i, 1:agent_num] = sorted_agent[i, 1:agent_num][permut_idx]
         return sorted_agent[..., :-1], sorted_mask
 
@@ -405,6 +349,8 @@ class WaymoAgent:
         return rect_list
 
     def get_polygon(self):
+        from shapely.geometry import Polygon  # only needed here, shapely is slow to import
+
         rect_list = self.get_rect(pad=0.25)  ## rect_list是agent四个角的坐标
 
         poly_list = []
@@ -429,42 +375,46 @@ class initDataset(Dataset):
     def __init__(self, cfg):
         self.data_path = cfg['data_path']
         self.cfg = cfg
-        self.data_loaded = {}
         self.load_data()
         super(initDataset, self).__init__()
 
     def load_data(self):
+        # processed cases are cached in shards, use_cache reuses the shards built with the same config
+        self.cache = ShardedCache(
+            os.path.join(self.data_path, 'init_cache'), self.cfg, ['map_size', 'sample_gap', 'min_agent'],
+            shard_size=self.cfg.get('cache_shard_size', 16), max_shards=self.cfg.get('cache_max_shards', 4)
+        )
+        shards = self.cache.shards(self.cfg['data_usage'])
         if self.cfg['use_cache']:
-            data_path = os.path.join(self.data_path, 'init_cache.pkl')
-            with open(data_path, 'rb+') as f:
-                self.data_loaded = pickle.load(f)
-            self.data_len = len(self.data_loaded)
-
+            shards = [shard for shard in shards if not self.cache.exists(shard)]
+
+        num_workers = self.cfg.get('preprocess_workers', 0)
+        if num_workers > 0:
+            # forking while the threads of torch are running can deadlock
+            with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+                for _ in tqdm(pool.imap_unordered(self.build_shard, shards), total=len(shards)):
+                    pass
         else:
-            cnt = 0
-            for file_indx in tqdm(range(self.cfg['data_usage'])):
-                data_path = self.data_path
-                data_file_path = os.path.join(data_path, f'{file_indx}.pkl')
-                # file_indx+=1
-                print(data_file_path)
-                with open(data_file_path, 'rb+') as f:
-                    datas = pickle.load(f)
-                data = self.process(datas)
-                case_cnt = 0
-                for i in range(len(data)):
-                    wash(data[i])
-                    agent_num = data[i]['agent_mask'].sum()  ## 这里的agent_num是指有效的agent数量
-                    if agent_num < self.cfg['min_agent']:  ## 保证可用车辆达到最低要求
-                        continue
-                    self.data_loaded[cnt + case_cnt] = data[i]
-                    case_cnt += 1
-                cnt += case_cnt
-            self.data_len = cnt
-
-            # save cache
-            data_path = os.path.join(self.data_path, 'init_cache.pkl')
-            with open(data_path, 'wb') as f:
-                pickle.dump(self.data_loaded, f)
+            for shard in tqdm(shards):
+                self.build_shard(shard)
+
+        self.cache.open(self.cfg['data_usage'])
+        self.data_len = len(self.cache)
+
+    def build_shard(self, shard):
+        """Process the files of a shard and save the cases to the cache, runs in the worker processes."""
+        case_list = []
+        for file_indx in range(*shard):
+            datas = load_scenario(self.data_path, file_indx)
+            # seeded by the file index, so the cases do not depend on the number of workers
+            data = self.process(datas, np.random.RandomState(file_indx))
+            for i in range(len(data)):
+                wash(data[i])
+                agent_num = data[i]['agent_mask'].sum()  ## 这里的agent_num是指有效的agent数量
+                if agent_num < self.cfg['min_agent']:  ## 保证可用车辆达到最低要求
+                    continue
+                case_list.append(data[i])
+        return self.cache.save(shard, case_list)
 
     def __len__(self):
         return self.data_len
@@ -473,25 +423,29 @@ class initDataset(Dataset):
         """
         Calculate for saving spaces
         """
-        return self.data_loaded[index]
+        return self.cache[index]
 
-    def process(self, data):
+    def process(self, data, rng=np.random):
         case_info = {}
 
         map_size = self.cfg['map_size']
         gap = self.cfg['sample_gap']
 
         # sample original data in a fixed interval
-        data['all_agent'] = data['all_agent'][0:-1:gap]
+        # copy the sampled frames, process_agent changes them in place and the loaded arrays may be read only
+        data['all_agent'] = data['all_agent'][0:-1:gap].copy()
         data['traffic_light'] = data['traffic_light'][0:-1:gap]
 
-        data['lane'] = transform_coordinate_map(data)   ##  变成了相对位置
+        # crop the map around the ego pose of every frame with a spatial index of the static map,
+        # instead of transforming the whole lane array to every frame with transform_coordinate_map
+        lane_index = LaneIndex(data['lane'])
+        ego_pose = data['all_agent'][:, 0][:, [0, 1, 4]]
 
-        case_info["agent"], case_info["agent_mask"] = process_agent(data['all_agent'], map_size, False)  ## 变成了相对位置
+        case_info["agent"], case_info["agent_mask"] = process_agent(data['all_agent'], map_size, False, rng)  ## 变成了相对位置
 
         case_info['center'], case_info['center_mask'], case_info['bound'], case_info['bound_mask'], \
-            case_info['cross'], case_info['cross_mask'], case_info['rest'], case_info['rest_mask'] = process_map(
-            data['lane'], data['traffic_light'], lane_range=self.cfg['map_size'], offest=0)
+            case_info['cross'], case_info['cross_mask'], case_info['rest'], case_info['rest_mask'] = \
+            lane_index.process_map(ego_pose, data['traffic_light'], lane_range=self.cfg['map_size'], offest=0)
 
         get_vec_rep(case_info) ##TODO
 
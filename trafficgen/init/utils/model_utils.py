@@ -205,11 +205,13 @@ class MCG_block(nn.Module):
         super(MCG_block, self).__init__()
         self.MLP = nn.Sequential(nn.Linear(hidden_dim, hidden_dim), nn.LayerNorm(hidden_dim), nn.ReLU())
 
-    def forward(self, inp, context, mask):
+    def forward(self, inp, context, mask, encoded=False):
         context = context.unsqueeze(1)
         mask = mask.unsqueeze(-1)
 
-        inp = self.MLP(inp)
+        # the MLP does not depend on the context, its output can be given directly with encoded=True
+        if not encoded:
+            inp = self.MLP(inp)
         inp = inp * context
         inp = inp.masked_fill(mask == 0, torch.tensor(-1e9))
         context = torch.max(inp, dim=1)[0]
@@ -224,9 +226,9 @@ class CG_stacked(nn.Module):
         for i in range(stack_num):
             self.CGs.append(MCG_block(hidden_dim))
 
-    def forward(self, inp, context, mask):
+    def forward(self, inp, context, mask, encoded=False):
 
-        inp_, context_ = self.CGs[0](inp, context, mask)
+        inp_, context_ = self.CGs[0](inp, context, mask, encoded)
         for i in range(1, self.stack_num):
             inp, context = self.CGs[i](inp_, context_, mask)
             inp_ = (inp_ * i + inp) / (i + 1)
@@ -414,6 +416,74 @@ class LocalSubGraph(nn.Module):
         return x
 
 
+class GaussianMixture:
+    """
+    Mixture of K gaussians in n = 1 or 2 dimensions, straight from the raw head output in shape [..., K, 1 + 5] for
+    n = 2 (weight logit, mean, correlation before tanh, log of the two sigmas) or [..., K, 1 + 2] for n = 1 (weight
+    logit, mean, log sigma). Same log_prob as MixtureSameFamily over MultivariateNormal or Normal, without building
+    the covariance matrices: the cholesky factor of a 2x2 covariance has a closed form.
+    """
+    def __init__(self, out, n):
+        self.out = out
+        self.n = n
+        self.logits = out[..., 0]
+        if n == 2:
+            self.loc = out[..., 1:3]
+            self.rho = torch.tanh(out[..., 3])
+            self.log_sigma = out[..., 4:6]
+        else:
+            self.loc = out[..., 1]
+            self.log_sigma = out[..., 2]
+
+    def select(self, *index):
+        """The mixtures at index of the batch dimensions, e.g. (rows, vectors)."""
+        return GaussianMixture(self.out[index], self.n)
+
+    @property
+    def mean(self):
+        weight = torch.softmax(self.logits, dim=-1)
+        if self.n == 2:
+            return torch.sum(weight.unsqueeze(-1) * self.loc, dim=-2)
+        return torch.sum(weight * self.loc, dim=-1)
+
+    def component_log_prob(self, x):
+        if self.n == 1:
+            # same as torch.distributions.Normal
+            var = torch.exp(self.log_sigma)**2
+            return -((x.unsqueeze(-1) - self.loc)**2) / (2 * var) - self.log_sigma - math.log(math.sqrt(2 * math.pi))
+
+        # L = [[s1, 0], [rho * s2, s2 * sqrt(1 - rho^2)]] is the cholesky factor of the covariance
+        sigma = torch.exp(self.log_sigma)
+        diff = x.unsqueeze(-2) - self.loc
+        z_1 = diff[..., 0] / sigma[..., 0]
+        z_2 = (diff[..., 1] - self.rho * sigma[..., 1] * z_1) / (sigma[..., 1] * torch.sqrt(1 - self.rho**2))
+        half_log_det = self.log_sigma[..., 0] + self.log_sigma[..., 1] + 0.5 * torch.log(1 - self.rho**2)
+        return -0.5 * (2 * math.log(2 * math.pi) + z_1**2 + z_2**2) - half_log_det
+
+    def log_prob(self, x):
+        log_weight = torch.log_softmax(self.logits, dim=-1)
+        return torch.logsumexp(self.component_log_prob(x) + log_weight, dim=-1)
+
+    def sample(self, sample_shape=()):
+        shape = torch.Size(sample_shape) + self.logits.shape[:-1]
+        k = torch.distributions.Categorical(logits=self.logits).sample(sample_shape).unsqueeze(-1)
+
+        def pick(param):
+            return torch.gather(param.expand(*shape, param.shape[-1]), -1, k).squeeze(-1)
+
+        if self.n == 1:
+            eps = torch.randn(shape, device=self.out.device, dtype=self.out.dtype)
+            return pick(self.loc) + torch.exp(pick(self.log_sigma)) * eps
+
+        eps = torch.randn([*shape, 2], device=self.out.device, dtype=self.out.dtype)
+        rho = pick(self.rho)
+        sigma_1 = torch.exp(pick(self.log_sigma[..., 0]))
+        sigma_2 = torch.exp(pick(self.log_sigma[..., 1]))
+        x_1 = pick(self.loc[..., 0]) + sigma_1 * eps[..., 0]
+        x_2 = pick(self.loc[..., 1]) + sigma_2 * (rho * eps[..., 0] + torch.sqrt(1 - rho**2) * eps[..., 1])
+        return torch.stack([x_1, x_2], dim=-1)
+
+
 class MLP_3(nn.Module):
     def __init__(self, dims):
         super(MLP_3, self).__init__()
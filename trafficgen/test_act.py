@@ -11,6 +11,7 @@ from trafficgen.init.utils.init_dataset import WaymoAgent
 # General config
 from trafficgen.utils.config import get_parsed_args
 from trafficgen.utils.config import load_config_act
+from trafficgen.utils.utils import box_intersect
 
 
 def wash(batch):
@@ -28,11 +29,10 @@ def get_SCR(pred):
     collide_idx = np.zeros(pred.shape[0])
     for i in range(pred.shape[0]):
         agent = WaymoAgent(pred[[i]])
-        polygons = agent.get_polygon()
-        for idx, poly in enumerate(polygons):
-            for ano_idx, another_poly in enumerate(polygons):
-                if poly.intersects(another_poly) and idx != ano_idx:
-                    collide_idx[idx] = 1
+        boxes = np.stack(agent.get_rect(pad=0.25))
+        intersect = box_intersect(boxes, boxes)
+        np.fill_diagonal(intersect, False)
+        collide_idx[:boxes.shape[0]][intersect.any(1)] = 1
 
     return np.mean(collide_idx)
 
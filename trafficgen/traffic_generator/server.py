@@ -0,0 +1,249 @@
+import argparse
+import copy
+import os
+import queue
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import torch
+
+from trafficgen.traffic_generator.traffic_generator import TrafficGen
+from trafficgen.traffic_generator.utils.data_utils import collate_cases
+from trafficgen.utils.config import load_config_init
+
+
+def default_socket():
+    """
+    trafficgen.sock in the runtime dir of the user, or else in a trafficgen-<uid> dir of the temp dir, which only the
+    user can access.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        runtime_dir = os.path.join(tempfile.gettempdir(), f'trafficgen-{os.getuid()}')
+        os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+        info = os.lstat(runtime_dir)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise PermissionError(f'{runtime_dir} is not a private dir of the user')
+    return os.path.join(runtime_dir, 'trafficgen.sock')
+
+
+def authkey_path(path):
+    """The key file next to the socket path, which the clients of the same user read the authkey from."""
+    return path + '.key'
+
+
+def read_authkey(path):
+    with open(authkey_path(path), 'rb') as f:
+        return f.read()
+
+
+def write_authkey(path):
+    """Write a new random authkey for the socket path, readable only by the user."""
+    authkey = os.urandom(32)
+    key_file = authkey_path(path)
+    if os.path.lexists(key_file):
+        os.remove(key_file)
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return authkey
+
+
+class GenerationServer:
+    """
+    Keeps a TrafficGen with its models loaded and generates scenarios on request. The requests wait in a queue, a
+    worker thread takes up to server_batch_size of them at a time and places vehicles in and rolls out all of them
+    together. A scenario is given like a pkl file of data_path, the result is the placed scenario of place_vehicles
+    with the rolled out trajectories in 'traj', in shape [190, agent_num, 8].
+    """
+    def __init__(self, cfg):
+        self.tg = TrafficGen(cfg)
+        self.batch_size = cfg.get('server_batch_size', 8)
+        # after the first request, wait at most server_max_wait seconds for more to batch with it
+        self.max_wait = cfg.get('server_max_wait', 0.01)
+        self.requests = queue.Queue()
+        self.worker = None
+
+    def start(self):
+        """Load the models and start the worker thread."""
+        self.tg.init_model.eval()
+        self.tg.act_model.eval()
+        self.worker = threading.Thread(target=self.serve_requests, daemon=True)
+        self.worker.start()
+        return self
+
+    def stop(self):
+        """Stop the worker thread once the requests queued before are done."""
+        self.requests.put(None)
+        self.worker.join()
+
+    def submit(self, scenario, rollout=True):
+        """Queue a scenario, returns a Future of its result. Without rollout only the vehicles are placed."""
+        future = Future()
+        self.requests.put((scenario, rollout, future))
+        return future
+
+    def generate(self, scenario, rollout=True):
+        return self.submit(scenario, rollout).result()
+
+    def next_batch(self):
+        """Block until a request arrives, then collect the requests arriving within max_wait, None to stop."""
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def serve_requests(self):
+        # grad mode is per thread
+        with torch.no_grad():
+            while True:
+                batch = self.next_batch()
+                stop = batch[-1] is None
+                requests = [request for request in batch if request is not None]
+                if requests:
+                    self.run_batch(requests)
+                if stop:
+                    return
+
+    def run_batch(self, requests):
+        # cancelled requests are dropped
+        requests = [request for request in requests if request[2].set_running_or_notify_cancel()]
+        if not requests:
+            return
+        # a scenario that fails to process only fails its own request, the others are batched without it
+        processed = []
+        for scenario, rollout, future in requests:
+            try:
+                # processing modifies the scenario in place, keep the one of the caller intact
+                case = self.tg.data_loader.dataset.process(copy.deepcopy(scenario))
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            processed.append((scenario, case, rollout, future))
+        if not processed:
+            return
+        scenarios, cases, rollouts, futures = zip(*processed)
+        try:
+            results = self.generate_batch(scenarios, cases, rollouts)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def generate_batch(self, scenarios, cases, rollouts):
+        """
+        Place vehicles in all the scenarios together, cases are the scenarios processed by the dataset, then roll out
+        those with rollout together.
+        """
+        tg = self.tg
+        context_num = tg.cfg['context_num']
+        batch = collate_cases(list(cases))
+        model_outputs = tg.place_vehicles_for_batch(batch, context_num=context_num)
+        results = [
+            tg.placed_scenario(model_output, other, context_num, scenario)
+            for model_output, other, scenario in zip(model_outputs, batch['other'], scenarios)
+        ]
+
+        rollout_results = [result for result, rollout in zip(results, rollouts) if rollout]
+        if rollout_results:
+            for result, traj in zip(rollout_results, tg.inference_control_batch(rollout_results)):
+                result['traj'] = traj
+        return results
+
+    def serve_unix(self, path=None, authkey=None):
+        """
+        Serve the requests of GenerationClient on the unix socket path until interrupted, every connection is handled
+        by its own thread, so that the requests of several clients are batched together.
+        The socket is accessible only by the user, and the clients must know the authkey. Without authkey a new one is
+        written next to the socket, see authkey_path. An old socket at path is replaced, any other file is not.
+        """
+        path = path or default_socket()
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError(f'{path} exists and is not a socket')
+            os.remove(path)
+        if authkey is None:
+            authkey = write_authkey(path)
+        # no access for others between the bind and the chmod
+        umask = os.umask(0o077)
+        try:
+            listener = Listener(path, family='AF_UNIX', authkey=authkey)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        with listener:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, ConnectionError):
+                    # a client with a wrong authkey or gone during the handshake
+                    continue
+                threading.Thread(target=self.serve_connection, args=(conn, ), daemon=True).start()
+
+    def serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    scenario, rollout = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    conn.send((True, self.generate(scenario, rollout)))
+                except Exception as e:
+                    conn.send((False, e))
+
+
+class GenerationClient:
+    """
+    Requests scenarios from a GenerationServer serving on the unix socket path, by default the one of serve_unix.
+    Without authkey it is read from the key file the server wrote next to the socket.
+    """
+    def __init__(self, path=None, authkey=None):
+        path = path or default_socket()
+        if authkey is None:
+            authkey = read_authkey(path)
+        self.conn = Client(path, family='AF_UNIX', authkey=authkey)
+
+    def generate(self, scenario, rollout=True):
+        self.conn.send((scenario, rollout))
+        ok, result = self.conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    """
+    Usage: python traffic_generator/server.py [--socket PATH]
+    Then in the client, of the same user:
+        client = GenerationClient()  # or GenerationClient(PATH)
+        result = client.generate(scenario)
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', '-c', type=str, default='local')
+    parser.add_argument('--socket', '-s', type=str, default=None, help='default: trafficgen.sock in the runtime dir')
+    args = parser.parse_args()
+
+    cfg = load_config_init(args.config)
+    # the int8 models only run on cpu
+    if torch.cuda.is_available() and not cfg.get('quantized', False):
+        cfg["device"] = "cuda"
+
+    path = args.socket or default_socket()
+    server = GenerationServer(cfg).start()
+    print(f'Serving on {path}')
+    server.serve_unix(path)
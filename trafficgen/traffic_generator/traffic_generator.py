@@ -1,42 +1,99 @@
 import copy
+import itertools
+import multiprocessing
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 
-import imageio
 import numpy as np
 import torch
 from torch import Tensor
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from trafficgen.act.model.tg_act import actuator
-from trafficgen.init.model.tg_init import initializer
-from trafficgen.init.utils.init_dataset import WaymoAgent
-from trafficgen.traffic_generator.utils.data_utils import InitDataset, save_as_metadrive_data, from_list_to_batch, \
-    transform_to_agent, process_case_to_input
-from trafficgen.traffic_generator.utils.vis_utils import draw, draw_seq
-from trafficgen.utils.utils import process_map, rotate
+from trafficgen.traffic_generator.utils.data_utils import InitDataset, save_as_metadrive_data, \
+    transform_to_agents, process_cases_to_input, collate_cases, load_case
+from trafficgen.traffic_generator.utils.pipeline import TaskWindow, background, pool_map
+from trafficgen.utils.scenario_store import load_scenario
+from trafficgen.utils.utils import process_map, rotate, LaneIndex, WaymoAgent, inference_autocast
 
 TRAFFICGEN_ROOT = os.path.dirname(os.path.dirname(__file__))
 
 
+def to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.cpu().numpy()
+    return x
+
+
 class TrafficGen:
     def __init__(self, cfg):
         self.cfg = cfg
-        self.init_model = initializer.load_from_checkpoint(
-            os.path.join(TRAFFICGEN_ROOT, "traffic_generator", "ckpt", "init.ckpt")
-        )
-        # act = actuator()
-        # state = torch.load('traffic_generator/ckpt/act.ckpt', map_location='cpu')
-        # act = torch.nn.DataParallel(act, device_ids=[0])
-        # act.load_state_dict(state["state_dict"])
-        # self.act_model = act
-        self.act_model = actuator.load_from_checkpoint(
-            os.path.join(TRAFFICGEN_ROOT, "traffic_generator", "ckpt", "act.ckpt")
-        )
+        # the models are loaded on first use, placing vehicles or generating trajectories alone loads only one of them
+        self._init_model = None
+        self._act_model = None
         init_dataset = InitDataset(cfg)
         self.data_loader = DataLoader(init_dataset, shuffle=False, batch_size=1, num_workers=0)
 
+    @property
+    def init_model(self):
+        if self._init_model is None:
+            self._init_model = self.load_model('init')
+        return self._init_model
+
+    @init_model.setter
+    def init_model(self, model):
+        self._init_model = model
+
+    @property
+    def act_model(self):
+        if self._act_model is None:
+            self._act_model = self.load_model('act')
+        return self._act_model
+
+    @act_model.setter
+    def act_model(self, model):
+        self._act_model = model
+
+    def load_model(self, name):
+        """
+        Load the initializer (name 'init') or the actuator ('act') from traffic_generator/ckpt: the int8 model with
+        quantized, the TorchScript graph with torchscript, the checkpoint otherwise. pytorch_lightning is only imported
+        here. With micro_batching, the model calls of concurrent threads are batched together.
+        """
+        ckpt_path = os.path.join(TRAFFICGEN_ROOT, "traffic_generator", "ckpt")
+        if self.cfg.get('quantized', False):
+            # int8 models exported by traffic_generator/utils/quantize.py, they only run on cpu
+            if self.cfg['device'] != 'cpu':
+                raise ValueError(
+                    f"quantized: True needs device: 'cpu', the int8 models do not run on {self.cfg['device']}"
+                )
+            from trafficgen.traffic_generator.utils.quantize import load_quantized
+            model = load_quantized(self.model_class(name), os.path.join(ckpt_path, f"{name}_int8.pt"))
+        elif self.cfg.get('torchscript', False):
+            # graphs traced by traffic_generator/utils/export_graph.py
+            from trafficgen.traffic_generator.utils.export_graph import load_graph
+            model = load_graph(name, self.cfg, ckpt_path)
+        else:
+            model = self.model_class(name).load_from_checkpoint(os.path.join(ckpt_path, f"{name}.ckpt"))
+
+        if self.cfg.get('micro_batching', False):
+            from trafficgen.traffic_generator.utils.batching import batched_model
+            model = batched_model(name, model.eval(), self.cfg, self.autocast)
+        return model
+
+    @staticmethod
+    def model_class(name):
+        if name == 'init':
+            from trafficgen.init.model.tg_init import initializer
+            return initializer
+        from trafficgen.act.model.tg_act import actuator
+        return actuator
+
+    def autocast(self):
+        """Autocast context of the inference_precision in the config, fp32 by default."""
+        return inference_autocast(self.cfg['device'], self.cfg.get('inference_precision', 'fp32'))
+
     def wash(self, batch):
         """Transform the loaded raw data to pretty pytorch tensor."""
         for key in batch.keys():
@@ -54,20 +111,54 @@ class TrafficGen:
         # self.raw_vehicles(vis=True)
         print('Complete.\n' 'Visualization results are saved in traffic_generator/output/vis/scene_raw\n')
 
-        print('Initializing traffic scenarios...')
-        self.place_vehicles(vis=True)
-        print('Complete.\n' 'Visualization results are saved in traffic_generator/output/vis/scene_initialized\n')
+        print('Initializing traffic scenarios and generating trajectories...')
+        workers = self.cfg.get('pipeline_workers', 0)
+        if workers > 0:
+            self.generate_pipelined(workers, gif, save_metadrive)
+        else:
+            # the placed scenarios flow straight into the rollout, they are only written to disk with save_initialized
+            scenarios = self.placed_scenarios(vis=True)
+            if self.cfg.get('save_initialized', False):
+                scenarios = self.save_placed(scenarios)
+            self.generate_traj(snapshot=True, gif=gif, save_metadrive=save_metadrive, scenarios=scenarios)
+        print(
+            'Complete.\n'
+            'Visualization results are saved in traffic_generator/output/vis/scene_initialized and '
+            'traffic_generator/output/vis/scene_static\n'
+        )
 
-        print('Generating trajectories...')
-        self.generate_traj(snapshot=True, gif=gif, save_metadrive=save_metadrive)
-        print('Complete.\n' 'Visualization results are saved in traffic_generator/output/vis/scene_static\n')
+    def generate_pipelined(self, workers, gif=True, save_metadrive=False):
+        """
+        The placement and rollout of generate_scenarios with all the stages running at the same time: the scenarios
+        are loaded and processed in a pool of workers processes, placed in a background thread and rolled out in this
+        one, the drawing and the export run in the pool. Every stage is at most pipeline_queue_size scenarios ahead of
+        the next one.
+        """
+        size = self.cfg.get('pipeline_queue_size', 8)
+        data_usage = self.cfg['data_usage']
+        # forking while the threads of torch are running can deadlock
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            cases = pool_map(pool, load_case, [(self.cfg, idx) for idx in range(data_usage)], size)
+            draws = TaskWindow(pool, size)
+            scenarios = self.placed_scenarios(vis=True, cases=zip(range(data_usage), cases), tasks=draws)
+            if self.cfg.get('save_initialized', False):
+                scenarios = self.save_placed(scenarios)
+            self.generate_traj(
+                snapshot=True,
+                gif=gif,
+                save_metadrive=save_metadrive,
+                scenarios=background(scenarios, size),
+                tasks=TaskWindow(pool, size)
+            )
+            draws.join()
 
     def place_vehicles_for_single_scenario(self, batch, index=None, vis=False, vis_dir=None, context_num=1):
         self.wash(batch)
 
         # Call the initialization model
         # The output is a dict with these keys: center, rest, bound, agent
-        model_output = self.init_model.inference(batch, context_num=context_num)
+        with self.autocast():
+            model_output = self.init_model.inference(batch, context_num=context_num)
 
         center = batch['center'][0].cpu().numpy()
         rest = batch['rest'][0].cpu().numpy()
@@ -77,17 +168,49 @@ class TrafficGen:
         if vis:
             assert vis_dir is not None
             assert index is not None
+            # the visualization stack is only imported when drawing
+            from trafficgen.traffic_generator.utils.vis_utils import draw
             output_path = os.path.join(vis_dir, f'{index}')
             draw(center, model_output['agent'], other=rest, edge=bound, save=True, path=output_path)
             print("Visualization results are saved at", output_path)
 
         return model_output
 
+    def place_vehicles_for_batch(self, batch, indices=None, vis=False, vis_dir=None, context_num=1, tasks=None):
+        """
+        Same as place_vehicles_for_single_scenario for a batch of scenarios, returns the output of every scenario. The
+        drawing is submitted to tasks, a TaskWindow, if given.
+        """
+        tasks = tasks or TaskWindow()
+        self.wash(batch)
+
+        occupancy = self.cfg.get('occupancy_placement', False)
+        with self.autocast():
+            model_outputs = self.init_model.inference_batch(batch, context_num=context_num, occupancy=occupancy)
+
+        if vis:
+            assert vis_dir is not None
+            assert indices is not None
+            from trafficgen.traffic_generator.utils.vis_utils import draw
+            for b, index in enumerate(indices):
+                center = batch['center'][b].cpu().numpy()
+                rest = batch['rest'][b].cpu().numpy()
+                bound = batch['bound'][b].cpu().numpy()
+                output_path = os.path.join(vis_dir, f'{index}')
+                tasks.submit(
+                    draw, center, model_outputs[b]['agent'], other=rest, edge=bound, save=True, path=output_path
+                )
+                print("Visualization results are saved at", output_path)
+
+        return model_outputs
+
     def raw_vehicles(self, vis=True):
         '''
         画出原始的交通场景，保存文件路径：
         traffic_generator/output/vis/scene_raw/
         '''
+        from trafficgen.traffic_generator.utils.vis_utils import draw
+
         raw_vis_dir = 'traffic_generator/output/vis/scene_raw/'
         if not os.path.exists(raw_vis_dir):
             os.makedirs(raw_vis_dir)
@@ -108,56 +231,98 @@ class TrafficGen:
         return
 
     def place_vehicles(self, vis=True):
+        """Place vehicles in every scenario of the dataset and save them to initialized_tmp for generate_traj."""
+        for _ in self.save_placed(self.placed_scenarios(vis)):
+            pass
+
+    def placed_scenarios(self, vis=True, cases=None, tasks=None):
+        """
+        Place vehicles in the scenarios, init_batch_size scenarios at a time, and yield the index and the placed
+        scenario of each as soon as its batch is done. cases yields the index and the case of every scenario, all the
+        scenarios of the dataset by default. The drawing is submitted to tasks, a TaskWindow, if given.
+        """
         context_num = self.cfg['context_num']
 
         init_vis_dir = 'traffic_generator/output/vis/scene_initialized'
         if not os.path.exists(init_vis_dir):
             os.makedirs(init_vis_dir)
-        tmp_pth = 'traffic_generator/output/initialized_tmp'
-        if not os.path.exists(tmp_pth):
-            os.makedirs(tmp_pth)
 
         self.init_model.eval()
 
         data_path = self.cfg['data_path']
-        with torch.no_grad():
-            for idx, data in enumerate(tqdm(self.data_loader)):
-                data_file_path = os.path.join(data_path, f'{idx}.pkl')
-                with open(data_file_path, 'rb+') as f:
-                    original_data = pickle.load(f)
-
-                batch = copy.deepcopy(data)
-
-                model_output = self.place_vehicles_for_single_scenario(batch, idx, vis, init_vis_dir, context_num)
-
-                agent, agent_mask = WaymoAgent.from_list_to_array(model_output['agent'])
-
-                # save temp data for trafficgen to generate trajectory
-                for key in batch.keys():
-                    if isinstance(batch[key], torch.Tensor):
-                        batch[key] = batch[key].cpu().numpy()
-                output = {}
-                output['context_num'] = context_num
-                output['all_agent'] = agent
-                output['agent_mask'] = agent_mask
-                output['lane'] = batch['other']['lane'][0].cpu().numpy()
-                output['unsampled_lane'] = batch['other']['unsampled_lane'][0].cpu().numpy()
-                output['traf'] = self.data_loader.dataset[idx]['other']['traf']
-                output['gt_agent'] = batch['other']['gt_agent'][0].cpu().numpy()
-                output['gt_agent_mask'] = batch['other']['gt_agent_mask'][0].cpu().numpy()
-
-                if "center_info" in original_data:
-                    output['center_info'] = original_data['center_info']
-                else:
-                    output["center_info"] = {}
-
-                p = os.path.join(tmp_pth, f'{idx}.pkl')
-                with open(p, 'wb') as f:
-                    pickle.dump(output, f)
-
-        return
-
-    def generate_traj(self, snapshot=True, gif=False, save_metadrive=False):
+        if cases is None:
+            dataset = self.data_loader.dataset
+            cases = ((idx, dataset[idx]) for idx in range(len(dataset)))
+        init_batch_size = self.cfg.get('init_batch_size', 1)
+        cases = iter(tqdm(cases, total=self.cfg['data_usage']))
+        while True:
+            chunk = list(itertools.islice(cases, init_batch_size))
+            if not chunk:
+                break
+            indices, case_list = zip(*chunk)
+            batch = collate_cases(list(case_list))
+
+            # not around the yield, the grad mode of the consumer would change with it
+            with torch.no_grad():
+                model_outputs = self.place_vehicles_for_batch(batch, indices, vis, init_vis_dir, context_num, tasks)
+
+            for idx, other, model_output in zip(indices, batch['other'], model_outputs):
+                original_data = load_scenario(data_path, idx)
+                yield idx, self.placed_scenario(model_output, other, context_num, original_data)
+
+    def save_placed(self, scenarios):
+        """Save the placed scenarios to initialized_tmp, where generate_traj reads them by default, and pass them on."""
+        tmp_pth = 'traffic_generator/output/initialized_tmp'
+        if not os.path.exists(tmp_pth):
+            os.makedirs(tmp_pth)
+        for idx, output in scenarios:
+            # save temp data for trafficgen to generate trajectory
+            p = os.path.join(tmp_pth, f'{idx}.pkl')
+            with open(p, 'wb') as f:
+                pickle.dump(output, f)
+            yield idx, output
+
+    def saved_scenarios(self):
+        """The scenarios saved by place_vehicles."""
+        for idx in range(self.cfg['data_usage']):
+            with open(f'traffic_generator/output/initialized_tmp/{idx}.pkl', 'rb+') as f:
+                yield idx, pickle.load(f)
+
+    @staticmethod
+    def placed_scenario(model_output, other, context_num, original_data):
+        """
+        The placed vehicles of a scenario with its map, the input of inference_control_batch. all_agent and agent_mask
+        only hold the placed vehicles, not the padding.
+        """
+        agent, agent_mask = WaymoAgent.from_list_to_array(model_output['agent'])
+        agent_num = agent_mask.sum()
+        agent, agent_mask = agent[:agent_num], agent_mask[:agent_num]
+
+        output = {}
+        output['context_num'] = context_num
+        output['all_agent'] = agent
+        output['agent_mask'] = agent_mask
+        output['lane'] = to_numpy(other['lane'])
+        output['unsampled_lane'] = to_numpy(other['unsampled_lane'])
+        output['traf'] = other['traf']
+        output['gt_agent'] = to_numpy(other['gt_agent'])
+        output['gt_agent_mask'] = to_numpy(other['gt_agent_mask'])
+
+        if "center_info" in original_data:
+            output['center_info'] = original_data['center_info']
+        else:
+            output["center_info"] = {}
+        return output
+
+    def generate_traj(self, snapshot=True, gif=False, save_metadrive=False, scenarios=None, tasks=None):
+        """
+        Roll out the placed scenarios, rollout_batch_size at a time. scenarios yields the index and the placed scenario
+        of each, like placed_scenarios, by default they are read from the files saved by place_vehicles. The drawing
+        and the export of the trajectories are submitted to tasks, a TaskWindow, if given.
+        """
+        tasks = tasks or TaskWindow()
+        if scenarios is None:
+            scenarios = tqdm(self.saved_scenarios(), total=self.cfg['data_usage'])
         snapshot_path = 'traffic_generator/output/vis/scene_static'
         if not os.path.exists(snapshot_path):
             os.makedirs(snapshot_path)
@@ -170,75 +335,20 @@ class TrafficGen:
 
         self.act_model.eval()
 
-        with torch.no_grad():
-            for i in tqdm(range(self.cfg['data_usage'])):
-                with open(f'traffic_generator/output/initialized_tmp/{i}.pkl', 'rb+') as f:
-                    data = pickle.load(f)
-                pred_i = self.inference_control(data)
-                if snapshot:
-                    ind = list(range(0, 190, 10))
-                    agent = pred_i[ind]
-
-                    agent_0 = agent[0]
-                    agent0_list = []
-                    agent_num = agent_0.shape[0]
-                    for a in range(agent_num):
-                        agent0_list.append(WaymoAgent(agent_0[[a]]))
-
-                    cent, cent_mask, bound, bound_mask, _, _, rest, _ = process_map(
-                        data['lane'][np.newaxis], [data['traf'][0]],
-                        center_num=1000,
-                        edge_num=500,
-                        offest=0,
-                        lane_range=60
-                    )
-                    img_path = os.path.join(snapshot_path, f'{i}')
-                    draw_seq(
-                        cent[0], agent0_list, agent[..., :2], edge=bound[0], other=rest[0], path=img_path, save=True
-                    )
-
-                if gif:
-                    dir_path = os.path.join(gif_path, f'{i}')
-                    if not os.path.exists(dir_path):
-                        os.mkdir(dir_path)
-
-                    ind = list(range(0, 190, 5))
-                    agent = pred_i[ind]
-                    if agent.shape[1] > 2:  # PZH: I don't know what this means here. Just add this if to avoid error.
-                        agent = np.delete(agent, [2], axis=1)
-                    for t in range(agent.shape[0]):
-                        agent_t = agent[t]
-                        agent_list = []
-                        for a in range(agent_t.shape[0]):
-                            agent_list.append(WaymoAgent(agent_t[[a]]))
-
-                        path = os.path.join(dir_path, f'{t}')
-                        cent, cent_mask, bound, bound_mask, _, _, rest, _ = process_map(
-                            data['lane'][np.newaxis], [data['traf'][int(t * 5)]],
-                            center_num=2000,
-                            edge_num=1000,
-                            offest=0,
-                            lane_range=80
-                        )
-                        draw(cent[0], agent_list, edge=bound[0], other=rest[0], path=path, save=True, vis_range=80)
-
-                    images = []
-                    for j in (range(38)):
-                        file_name = os.path.join(dir_path, f'{j}.png')
-                        img = imageio.imread(file_name)
-                        images.append(img)
-                    output = os.path.join(gif_path, f'movie_{i}.gif')
-                    imageio.mimsave(output, images, duration=0.1)
-
-                    # if t==0:
-                    #     center, _, bounder, _, _, _, rester = WaymoDataset.process_map(inp, 2000, 1000, 50,0)
-                    #     for k in range(1,agent_t.shape[0]):
-                    #         heat_path = os.path.join(dir_path, f'{k-1}')
-                    #         draw(cent, heat_map[k-1], agent_t[:k], rest, edge=bound, save=True, path=heat_path)
-
-                if save_metadrive:
-                    data_dir = os.path.join(pkl_path, f'{i}.pkl')
-                    save_as_metadrive_data(i, pred_i, data, data_dir)
+        rollout_batch_size = self.cfg.get('rollout_batch_size', 1)
+        scenarios = iter(scenarios)
+        while True:
+            chunk = list(itertools.islice(scenarios, rollout_batch_size))
+            if not chunk:
+                break
+            indices, data_list = zip(*chunk)
+            with torch.no_grad():
+                pred_list = self.inference_control_batch(data_list)
+            for i, data, pred_i in zip(indices, data_list, pred_list):
+                tasks.submit(
+                    self.save_traj, i, data, pred_i, snapshot_path, gif_path, pkl_path, snapshot, gif, save_metadrive
+                )
+        tasks.join()
 
         if gif:
             print("GIF files have been generated to vis/gif folder.")
@@ -246,8 +356,122 @@ class TrafficGen:
             print("Trajectory visualization has been generated to vis/snapshots folder.")
         print('Generated scenarios have been saved to generated_scenarios folder')
 
+    @staticmethod
+    def save_traj(i, data, pred_i, snapshot_path, gif_path, pkl_path, snapshot, gif, save_metadrive):
+        if snapshot:
+            from trafficgen.traffic_generator.utils.vis_utils import draw_seq
+
+            ind = list(range(0, 190, 10))
+            agent = pred_i[ind]
+
+            agent_0 = agent[0]
+            agent0_list = []
+            agent_num = agent_0.shape[0]
+            for a in range(agent_num):
+                agent0_list.append(WaymoAgent(agent_0[[a]]))
+
+            cent, cent_mask, bound, bound_mask, _, _, rest, _ = process_map(
+                data['lane'][np.newaxis], [data['traf'][0]],
+                center_num=1000,
+                edge_num=500,
+                offest=0,
+                lane_range=60
+            )
+            img_path = os.path.join(snapshot_path, f'{i}')
+            draw_seq(cent[0], agent0_list, agent[..., :2], edge=bound[0], other=rest[0], path=img_path, save=True)
+
+        if gif:
+            import imageio
+            from trafficgen.traffic_generator.utils.vis_utils import draw
+
+            dir_path = os.path.join(gif_path, f'{i}')
+            if not os.path.exists(dir_path):
+                os.mkdir(dir_path)
+
+            ind = list(range(0, 190, 5))
+            agent = pred_i[ind]
+            if agent.shape[1] > 2:  # PZH: I don't know what this means here. Just add this if to avoid error.
+                agent = np.delete(agent, [2], axis=1)
+            for t in range(agent.shape[0]):
+                agent_t = agent[t]
+                agent_list = []
+                for a in range(agent_t.shape[0]):
+                    agent_list.append(WaymoAgent(agent_t[[a]]))
+
+                path = os.path.join(dir_path, f'{t}')
+                cent, cent_mask, bound, bound_mask, _, _, rest, _ = process_map(
+                    data['lane'][np.newaxis], [data['traf'][int(t * 5)]],
+                    center_num=2000,
+                    edge_num=1000,
+                    offest=0,
+                    lane_range=80
+                )
+                draw(cent[0], agent_list, edge=bound[0], other=rest[0], path=path, save=True, vis_range=80)
+
+            images = []
+            for j in (range(38)):
+                file_name = os.path.join(dir_path, f'{j}.png')
+                img = imageio.imread(file_name)
+                images.append(img)
+            output = os.path.join(gif_path, f'movie_{i}.gif')
+            imageio.mimsave(output, images, duration=0.1)
+
+            # if t==0:
+            #     center, _, bounder, _, _, _, rester = WaymoDataset.process_map(inp, 2000, 1000, 50,0)
+            #     for k in range(1,agent_t.shape[0]):
+            #         heat_path = os.path.join(dir_path, f'{k-1}')
+            #         draw(cent, heat_map[k-1], agent_t[:k], rest, edge=bound, save=True, path=heat_path)
+
+        if save_metadrive:
+            data_dir = os.path.join(pkl_path, f'{i}.pkl')
+            save_as_metadrive_data(i, pred_i, data, data_dir)
+
     def inference_control(self, data, ego_gt=True, length=190, per_time=20):
         # for every x time step, pred then update
+        return self.inference_control_batch([data], ego_gt=ego_gt, length=length, per_time=per_time)[0]
+
+    def inference_control_batch(self, data_list, ego_gt=True, length=190, per_time=20):
+        """
+        Roll out several scenarios together. At every replanning step the agents of all scenarios are packed into
+        one actuator batch, and the prediction of each agent is routed back to its own scenario. Every agent is an
+        independent sample of the actuator, so each scenario gets the same trajectories as a serial rollout.
+        """
+        start_idx = 1 if ego_gt else 0
+        pred_agents = [self._init_rollout(data, ego_gt, length) for data in data_list]
+        # the map is static, index it once and crop it around every agent at every step
+        lane_indices = [LaneIndex(data['lane']) for data in data_list]
+
+        for i in range(0, length - 1, per_time):
+
+            current_agents = []
+            inp_list = []
+            for data, pred_agent, lane_index in zip(data_list, pred_agents, lane_indices):
+                current_agent = copy.deepcopy(pred_agent[i])
+                current_agents.append(current_agent)
+                # the cases of all agents in this scenario are transformed and cropped in one pass
+                agent, _ = transform_to_agents(current_agent)
+                pose = current_agent[:, [0, 1, 4]]
+                inp_list.append(process_cases_to_input(agent, lane_index, data['traf'][i], pose=pose))
+
+            batch = {key: Tensor(np.concatenate([inp[key] for inp in inp_list])) for key in inp_list[0].keys()}
+            self.wash(batch)
+            with self.autocast():
+                pred = self.act_model(batch)
+            best_pred = self.select_best_traj(pred)
+
+            ## scatter the packed prediction back to every scenario
+            offset = 0
+            for pred_agent, current_agent in zip(pred_agents, current_agents):
+                agent_num = current_agent.shape[0]
+                self._update_rollout(
+                    pred_agent, current_agent, best_pred[offset:offset + agent_num], i, per_time, start_idx
+                )
+                offset += agent_num
+
+        return pred_agents
+
+    @staticmethod
+    def _init_rollout(data, ego_gt, length):
         agent_num = data['agent_mask'].sum()
         data['agent_mask'] = data['agent_mask'][:agent_num]
         data['all_agent'] = data['all_agent'][:agent_num]
@@ -256,56 +480,42 @@ class TrafficGen:
         pred_agent[0, :, :7] = copy.deepcopy(data['all_agent'])
         pred_agent[1:, :, 5:7] = pred_agent[0, :, 5:7]
 
-        start_idx = 0
-
         if ego_gt == True:
             future_traj = data['gt_agent']
             pred_agent[:, 0, :7] = future_traj[:190, 0]
-            start_idx = 1
-
-        for i in range(0, length - 1, per_time):
-
-            current_agent = copy.deepcopy(pred_agent[i])
-            case_list = []
-            for j in range(agent_num):
-                a_case = {}
-                a_case['agent'], a_case['lane'] = transform_to_agent(current_agent[j], current_agent, data['lane'])
-                a_case['traf'] = data['traf'][i]
-                case_list.append(a_case)
-
-            inp_list = []
-            for case in case_list:
-                inp_list.append(process_case_to_input(case))
-            batch = from_list_to_batch(inp_list)
-
-            self.wash(batch)
-
-            pred = self.act_model(batch)
-            prob = pred['prob']
-            velo_pred = pred['velo']
-            pos_pred = pred['pos']
-            heading_pred = pred['heading']
-            all_pred = torch.cat([pos_pred, velo_pred, heading_pred.unsqueeze(-1)], dim=-1)
-
-            best_pred_idx = torch.argmax(prob, dim=-1)
-            best_pred_idx = best_pred_idx.view(agent_num, 1, 1, 1).repeat(1, 1, *all_pred.shape[2:])
-            best_pred = torch.gather(all_pred, dim=1, index=best_pred_idx).squeeze(1).cpu().numpy()
-
-            ## update all the agent
-            for j in range(start_idx, agent_num):
-                pred_j = best_pred[j]
-                agent_j = copy.deepcopy(current_agent[j])
-                center = copy.deepcopy(agent_j[:2])
-                center_yaw = copy.deepcopy(agent_j[4])
-
-                pos = rotate(pred_j[:, 0], pred_j[:, 1], center_yaw)
-                heading = pred_j[..., -1] + center_yaw
-                vel = rotate(pred_j[:, 2], pred_j[:, 3], center_yaw)
-
-                pos = pos + center
-                pad_len = pred_agent[i + 1:i + per_time + 1].shape[0]
-                pred_agent[i + 1:i + per_time + 1, j, :2] = copy.deepcopy(pos[:pad_len])
-                pred_agent[i + 1:i + per_time + 1, j, 2:4] = copy.deepcopy(vel[:pad_len])
-                pred_agent[i + 1:i + per_time + 1, j, 4] = copy.deepcopy(heading[:pad_len])
 
         return pred_agent
+
+    @staticmethod
+    def select_best_traj(pred):
+        """Pick the most probable mode of every agent, output is in shape [agent_num, pred_len, 5]."""
+        prob = pred['prob']
+        velo_pred = pred['velo']
+        pos_pred = pred['pos']
+        heading_pred = pred['heading']
+        all_pred = torch.cat([pos_pred, velo_pred, heading_pred.unsqueeze(-1)], dim=-1)
+
+        agent_num = all_pred.shape[0]
+        best_pred_idx = torch.argmax(prob, dim=-1)
+        best_pred_idx = best_pred_idx.view(agent_num, 1, 1, 1).repeat(1, 1, *all_pred.shape[2:])
+        best_pred = torch.gather(all_pred, dim=1, index=best_pred_idx).squeeze(1).cpu().numpy()
+        return best_pred
+
+    @staticmethod
+    def _update_rollout(pred_agent, current_agent, best_pred, i, per_time, start_idx):
+        ## update all the agent
+        for j in range(start_idx, current_agent.shape[0]):
+            pred_j = best_pred[j]
+            agent_j = copy.deepcopy(current_agent[j])
+            center = copy.deepcopy(agent_j[:2])
+            center_yaw = copy.deepcopy(agent_j[4])
+
+            pos = rotate(pred_j[:, 0], pred_j[:, 1], center_yaw)
+            heading = pred_j[..., -1] + center_yaw
+            vel = rotate(pred_j[:, 2], pred_j[:, 3], center_yaw)
+
+            pos = pos + center
+            pad_len = pred_agent[i + 1:i + per_time + 1].shape[0]
+            pred_agent[i + 1:i + per_time + 1, j, :2] = copy.deepcopy(pos[:pad_len])
+            pred_agent[i + 1:i + per_time + 1, j, 2:4] = copy.deepcopy(vel[:pad_len])
+            pred_agent[i + 1:i + per_time + 1, j, 4] = copy.deepcopy(heading[:pad_len])
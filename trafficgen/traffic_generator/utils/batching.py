@@ -0,0 +1,114 @@
+import contextlib
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from trafficgen.traffic_generator.utils.export_graph import ActGraph, GraphActuator, GraphInitializer, InitGraph
+
+
+def pad_dim1(tensors):
+    """Pad the tensors to the largest size in dim 1, with zeros (False for masks)."""
+    size = max(x.shape[1] for x in tensors)
+    padded = []
+    for x in tensors:
+        if x.shape[1] < size:
+            x = torch.cat([x, x.new_zeros([x.shape[0], size - x.shape[1], *x.shape[2:]])], dim=1)
+        padded.append(x)
+    return padded
+
+
+class BatchedCall:
+    """
+    Collects the calls of fn from many threads and runs them as one call, on the inputs of all the calls concatenated
+    in the batch dimension, then routes every row of the outputs back to its caller. fn takes tensors and returns a
+    tensor or a tuple of tensors, the rows of which only depend on the same rows of the inputs.
+    A worker thread waits for a first call, then for more calls until there are max_rows rows or max_wait seconds
+    have passed. With pad, the inputs are padded in dim 1 to the largest call (masks with False), with crop the outputs
+    are cropped in dim 1 back to the size of the first input of every call.
+    fn runs in the context of context(), for the autocast of the callers which does not carry over to the worker.
+    """
+    def __init__(self, fn, max_rows, max_wait, context=contextlib.nullcontext, pad=False, crop=False):
+        self.fn = fn
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.context = context
+        self.pad = pad
+        self.crop = crop
+        self.calls = queue.Queue()
+        threading.Thread(target=self.serve_calls, daemon=True).start()
+
+    def __call__(self, *inputs):
+        future = Future()
+        self.calls.put((inputs, future))
+        return future.result()
+
+    def next_calls(self):
+        calls = [self.calls.get()]
+        rows = calls[0][0][0].shape[0]
+        deadline = time.time() + self.max_wait
+        while rows < self.max_rows:
+            try:
+                calls.append(self.calls.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+            rows += calls[-1][0][0].shape[0]
+        return calls
+
+    def serve_calls(self):
+        # grad mode is per thread
+        with torch.no_grad():
+            while True:
+                self.run_calls(self.next_calls())
+
+    def run_calls(self, calls):
+        futures = [future for _, future in calls]
+        try:
+            rows = [inputs[0].shape[0] for inputs, _ in calls]
+            sizes = [inputs[0].shape[1] for inputs, _ in calls] if self.crop else None
+            inputs = []
+            for arg in zip(*[inputs for inputs, _ in calls]):
+                inputs.append(torch.cat(pad_dim1(arg) if self.pad else arg, dim=0))
+            with self.context():
+                outputs = self.fn(*inputs)
+            single = not isinstance(outputs, tuple)
+            outputs = (outputs, ) if single else outputs
+
+            results = [out.split(rows, dim=0) for out in outputs]
+            for j, future in enumerate(futures):
+                result = tuple(out[j] if sizes is None else out[j][:, :sizes[j]] for out in results)
+                future.set_result(result[0] if single else result)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class BatchedInitGraph:
+    """The methods of InitGraph, every one of them batched across the calling threads by a BatchedCall."""
+    def __init__(self, graph, max_rows, max_wait, context=contextlib.nullcontext):
+        self.encode_lane = BatchedCall(graph.encode_lane, max_rows, max_wait, context)
+        # the new agents are encoded one at a time, all the agents of the context at the start
+        self.encode_agent = BatchedCall(graph.encode_agent, max_rows, max_wait, context, pad=True, crop=True)
+        # the placement steps differ in their number of placed agents, the missing ones are masked
+        self.agent_context = BatchedCall(graph.agent_context, max_rows, max_wait, context, pad=True)
+        self.step = BatchedCall(graph, max_rows, max_wait, context)
+
+    def __call__(self, *inputs):
+        return self.step(*inputs)
+
+
+def batched_model(name, model, cfg, context=contextlib.nullcontext):
+    """
+    The initializer (name 'init') or the actuator ('act') with its model calls batched across the threads that use
+    it, model is a checkpoint or a graph loaded by export_graph.load_graph. The batches are closed after
+    init_micro_batch scenarios or act_micro_batch agents, or micro_batch_wait seconds.
+    """
+    max_wait = cfg.get('micro_batch_wait', 0.005)
+    if name == 'init':
+        graph = model.graph if isinstance(model, GraphInitializer) else InitGraph(model)
+        return GraphInitializer(BatchedInitGraph(graph, cfg.get('init_micro_batch', 16), max_wait, context), cfg)
+    graph = model.graph if isinstance(model, GraphActuator) else ActGraph(model)
+    return GraphActuator(BatchedCall(graph, cfg.get('act_micro_batch', 512), max_wait, context), cfg['device'])
@@ -4,10 +4,14 @@ import pickle
 
 import numpy as np
 from torch import Tensor
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, default_collate
 
+from trafficgen.traffic_generator.utils.torch_data_utils import process_data_to_internal_format as \
+    process_data_to_internal_format_torch
+from trafficgen.utils.scenario_store import load_scenario
 from trafficgen.utils.typedef import AgentType, RoadLineType, RoadEdgeType
-from trafficgen.utils.utils import process_map, rotate, cal_rel_dir, WaymoAgent
+from trafficgen.utils.utils import process_map, rotate, cal_rel_dir, WaymoAgent, LaneIndex, nearest_vec, compact, \
+    raster_sort
 
 TRAFFICGEN_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
@@ -45,6 +49,31 @@ def process_case_to_input(case, agent_range=60):
     return inp
 
 
+def process_cases_to_input(agent, lane, traf, agent_range=60, pose=None):
+    """
+    Batched process_case_to_input for the cases of all agents at one timestep. agent is in shape [case_num,
+    agent_num, 8] and lane in shape [case_num, lane_num, 4], both from transform_to_agents. The map of all cases is
+    cropped by a single process_map call and the returned arrays have a leading case dimension.
+    If pose ([case_num, 3], the x, y, yaw of every ego agent) is given, lane is the LaneIndex of the scenario.
+    """
+    inp = {}
+    case_num = agent.shape[0]
+    agent = WaymoAgent(agent)
+    agent = agent.get_inp(act_inp=True)
+    range_mask = (abs(agent[..., 0] - 40 / 50) < agent_range / 50) * (abs(agent[..., 1]) < agent_range / 50)
+
+    # move agents in range to the front, keeping their order, then keep the first 32 of them
+    (inp['agent'],), inp['agent_mask'] = compact(range_mask, 32, agent)
+
+    if pose is None:
+        map_output = process_map(lane, [traf] * case_num, center_num=256, edge_num=128, offest=-40, lane_range=60)
+    else:
+        map_output = lane.process_map(pose, [traf] * case_num, center_num=256, edge_num=128, offest=-40, lane_range=60)
+    inp['center'], inp['center_mask'], inp['bound'], inp['bound_mask'], \
+    inp['cross'], inp['cross_mask'], inp['rest'], inp['rest_mask'] = map_output
+    return inp
+
+
 def get_metadrive_line_type(line_type):
     from trafficgen.utils.get_md_data import INT_TO_METADRIVE_TYPE
     return INT_TO_METADRIVE_TYPE[line_type]
@@ -61,6 +90,13 @@ def from_list_to_batch(inp_list):
     return batch
 
 
+def collate_cases(case_list):
+    """Collate the cases of InitDataset into one batch, the 'other' entries are kept in a list with one per case."""
+    batch = default_collate([{key: value for key, value in case.items() if key != 'other'} for case in case_list])
+    batch['other'] = [case['other'] for case in case_list]
+    return batch
+
+
 def transform_to_agent(agent_i, agent, lane):
     all_ = copy.deepcopy(agent)
 
@@ -85,6 +121,34 @@ def transform_to_agent(agent_i, agent, lane):
     return all_, lane
 
 
+def transform_to_agents(agent, lane=None):
+    """
+    Vectorized transform_to_agent for every agent at once. agent is in shape [agent_num, 8] and lane in shape
+    [lane_num, 4]. Returns all agents and the lane in the ego frame of each agent, in shape [agent_num, agent_num, 8]
+    and [agent_num, lane_num, 4]. The lane is skipped if it is None, e.g. when the map is cropped with a LaneIndex.
+    """
+    agent_num = agent.shape[0]
+    center = agent[:, np.newaxis, :2]
+    center_yaw = agent[:, [4]]
+
+    all_ = np.repeat(agent[np.newaxis], agent_num, axis=0)
+    all_[..., :2] -= center
+    coord = rotate(all_[..., 0], all_[..., 1], -center_yaw)
+    vel = rotate(all_[..., 2], all_[..., 3], -center_yaw)
+
+    all_[..., :2] = coord
+    all_[..., 2:4] = vel
+    all_[..., 4] = all_[..., 4] - center_yaw
+    if lane is None:
+        return all_, None
+    # then recover lane's position
+    lane = np.repeat(lane[np.newaxis], agent_num, axis=0)
+    lane[..., :2] -= center
+    lane[..., :2] = rotate(lane[..., 0], lane[..., 1], -center_yaw)
+
+    return all_, lane
+
+
 def _traffic_light_state_template(object_id, track_length):
     """Borrowed from MetaDrive"""
     from metadrive.scenario.scenario_description import ScenarioDescription as SD, MetaDriveType
@@ -221,6 +285,7 @@ class InitDataset(Dataset):
         self.data_path = os.path.join(TRAFFICGEN_ROOT, cfg['data_path'])
 
         self.from_metadrive = cfg.get("from_metadrive", False)
+        self.preprocess_backend = cfg.get('preprocess_backend', 'numpy')
 
         self.data_len = None
         self.data_loaded = {}
@@ -230,18 +295,21 @@ class InitDataset(Dataset):
 
     def load_data(self):
 
-        data_path = self.data_path
         for i in range(self.total_data_usage):
-            data_file_path = os.path.join(data_path, f'{i}.pkl')
-            with open(data_file_path, 'rb+') as f:
-                datas = pickle.load(f)
+            self.data_loaded[i] = self.process(load_scenario(self.data_path, i))
 
-            if self.from_metadrive:
-                from trafficgen.utils.get_md_data import metadrive_scenario_to_init_data
-                datas = metadrive_scenario_to_init_data(datas)
+    def process(self, datas):
+        """The case of a scenario loaded from data_path (or given directly), as returned by __getitem__."""
+        if self.from_metadrive:
+            from trafficgen.utils.get_md_data import metadrive_scenario_to_init_data
+            datas = metadrive_scenario_to_init_data(datas)
 
+        if self.preprocess_backend == 'torch':
+            device = self.cfg.get('preprocess_device', self.cfg['device'])
+            data = process_data_to_internal_format_torch(datas, device)
+        else:
             data = process_data_to_internal_format(datas)
-            self.data_loaded[i] = data[0]
+        return data[0]
 
     def __len__(self):
         if not self.data_loaded:
@@ -259,6 +327,12 @@ class InitDataset(Dataset):
         return self.data_loaded[index]
 
 
+def load_case(cfg, idx):
+    """The case of scenario idx processed like in InitDataset, to load the scenarios in other processes."""
+    dataset = InitDataset(cfg)
+    return dataset.process(load_scenario(dataset.data_path, idx))
+
+
 def get_vec_based_rep(case_info):
 
     thres = 5
@@ -270,27 +344,8 @@ def get_vec_based_rep(case_info):
 
     agent_mask = case_info['agent_mask']
 
-    vec_x = ((vectors[..., 0] + vectors[..., 2]) / 2)
-    vec_y = ((vectors[..., 1] + vectors[..., 3]) / 2)
-
-    agent_x = agent[..., 0]
-    agent_y = agent[..., 1]
-
-    b, vec_num = vec_y.shape
-    _, agent_num = agent_x.shape
-
-    vec_x = np.repeat(vec_x[:, np.newaxis], axis=1, repeats=agent_num)
-    vec_y = np.repeat(vec_y[:, np.newaxis], axis=1, repeats=agent_num)
-
-    agent_x = np.repeat(agent_x[:, :, np.newaxis], axis=-1, repeats=vec_num)
-    agent_y = np.repeat(agent_y[:, :, np.newaxis], axis=-1, repeats=vec_num)
-
-    dist = np.sqrt((vec_x - agent_x)**2 + (vec_y - agent_y)**2)
-
-    cent_mask = np.repeat(case_info['center_mask'][:, np.newaxis], axis=1, repeats=agent_num)
-    dist[cent_mask == 0] = 10e5
-    vec_index = np.argmin(dist, -1)
-    min_dist_to_lane = np.min(dist, -1)
+    # nearest center lane vector of every agent
+    vec_index, min_dist_to_lane = nearest_vec(agent[..., :2], vectors, case_info['center_mask'])
     min_dist_mask = min_dist_to_lane < thres
 
     selected_vec = np.take_along_axis(vectors, vec_index[..., np.newaxis], axis=1)
@@ -331,10 +386,6 @@ def get_vec_based_rep(case_info):
     total_mask[:, 0] = 1
     total_mask = total_mask.astype(bool)
 
-    b_s, agent_num, agent_dim = agent.shape
-    agent_ = np.zeros([b_s, max_agent_num, agent_dim])
-    agent_mask_ = np.zeros([b_s, max_agent_num]).astype(bool)
-
     the_vec = np.take_along_axis(vectors, vec_index[..., np.newaxis], 1)
     # 0: vec_index
     # 1-2 long and lat percent
@@ -348,22 +399,8 @@ def get_vec_based_rep(case_info):
         ], -1
     )
 
-    info_ = np.zeros([b_s, max_agent_num, info.shape[-1]])
-
-    for i in range(agent.shape[0]):
-        agent_i = agent[i][total_mask[i]]
-        info_i = info[i][total_mask[i]]
-
-        agent_i = agent_i[:max_agent_num]
-        info_i = info_i[:max_agent_num]
-
-        valid_num = agent_i.shape[0]
-        agent_i = np.pad(agent_i, [[0, max_agent_num - agent_i.shape[0]], [0, 0]])
-        info_i = np.pad(info_i, [[0, max_agent_num - info_i.shape[0]], [0, 0]])
-
-        agent_[i] = agent_i
-        info_[i] = info_i
-        agent_mask_[i, :valid_num] = True
+    # move the valid agents to the front and keep the first max_agent_num of them
+    (agent_, info_), agent_mask_ = compact(total_mask, max_agent_num, agent, info)
 
     # case_info['vec_index'] = info[...,0].astype(int)
     # case_info['relative_dir'] = info[..., 1]
@@ -382,16 +419,13 @@ def get_vec_based_rep(case_info):
 
 def transform_coordinate_map(data):
     """
-    Every frame is different
+    Transform the lane and the unsampled lane to the ego frame of the first frame
     """
-    timestep = data['all_agent'].shape[0]
-
     # sdc_theta = data['sdc_theta'][:,np.newaxis]
-    ego = data['all_agent'][:, 0]
+    ego = data['all_agent'][[0], 0]
     pos = ego[:, [0, 1]][:, np.newaxis]
 
-    lane = data['lane'][np.newaxis]
-    lane = np.repeat(lane, timestep, axis=0)
+    lane = copy.deepcopy(data['lane'][np.newaxis])
     lane[..., :2] -= pos
 
     x = lane[..., 0]
@@ -399,15 +433,13 @@ def transform_coordinate_map(data):
     ego_heading = ego[:, [4]]
     lane[..., :2] = rotate(x, y, -ego_heading)
 
-    unsampled_lane = data['unsampled_lane'][np.newaxis]
-    unsampled_lane = np.repeat(unsampled_lane, timestep, axis=0)
+    unsampled_lane = copy.deepcopy(data['unsampled_lane'][np.newaxis])
     unsampled_lane[..., :2] -= pos
 
     x = unsampled_lane[..., 0]
     y = unsampled_lane[..., 1]
-    ego_heading = ego[:, [4]]
     unsampled_lane[..., :2] = rotate(x, y, -ego_heading)
-    return lane, unsampled_lane[0]
+    return lane[0], unsampled_lane[0]
 
 
 def process_agent(agent, sort_agent):
@@ -427,33 +459,12 @@ def process_agent(agent, sort_agent):
     agent_range_mask = (abs(agent[..., 0]) < RANGE) * (abs(agent[..., 1]) < RANGE)
     mask = agent_mask * agent_type_mask * agent_range_mask
 
-    bs, agent_num, _ = agent.shape
     sorted_agent = np.zeros_like(agent)
     sorted_mask = np.zeros_like(agent_mask).astype(bool)
     sorted_agent[:, 0] = agent[:, 0]
     sorted_mask[:, 0] = True
-    for i in range(bs):
-        xy = copy.deepcopy(agent[i, 1:, :2])
-        agent_i = copy.deepcopy(agent[i, 1:])
-        mask_i = mask[i, 1:]
-
-        # put invalid agent to the right down side
-        xy[mask_i == False, 0] = 10e8
-        xy[mask_i == False, 1] = -10e8
-
-        raster = np.floor(xy / 0.25)
-        raster = np.concatenate([raster, agent_i, mask_i[:, np.newaxis]], -1)
-        y_index = np.argsort(-raster[:, 1])
-        raster = raster[y_index]
-        y_set = np.unique(raster[:, 1])[::-1]
-        for y in y_set:
-            ind = np.argwhere(raster[:, 1] == y)[:, 0]
-            ys = raster[ind]
-            x_index = np.argsort(ys[:, 0])
-            raster[ind] = ys[x_index]
-        # scene = np.delete(raster, [0, 1], axis=-1)
-        sorted_agent[i, 1:] = raster[..., 2:-1]
-        sorted_mask[i, 1:] = raster[..., -1]
+    # sort all frames at once, invalid agents are put at the end
+    sorted_agent[:, 1:], sorted_mask[:, 1:] = raster_sort(agent[:, 1:], mask[:, 1:])
 
     if sort_agent:
         return sorted_agent[..., :-1], sorted_mask
@@ -483,12 +494,13 @@ def get_gt(case_info):
     gt_distribution = np.zeros([b, lane_num])
     gt_vec_based_coord = np.zeros([b, lane_num, 5])
     gt_bbox = np.zeros([b, lane_num, 2])
-    for i in range(b):
-        mask = case_info['agent_mask'][i].sum()
-        index = agent_vec_index[i].astype(int)
-        gt_distribution[i][index[:mask]] = 1
-        gt_vec_based_coord[i, index] = vec_based_rep[i, :, :5]
-        gt_bbox[i, index] = bbox[i]
+    # scatter all timesteps at once, for agents on the same vector the later one is kept
+    batch_index = np.arange(b)[:, np.newaxis]
+    index = agent_vec_index.astype(int)
+    agent_mask = case_info['agent_mask']
+    gt_distribution[np.nonzero(agent_mask)[0], index[agent_mask]] = 1
+    gt_vec_based_coord[batch_index, index] = vec_based_rep[..., :5]
+    gt_bbox[batch_index, index] = bbox
     case_info['gt_bbox'] = gt_bbox
     case_info['gt_distribution'] = gt_distribution
     case_info['gt_long_lat'] = gt_vec_based_coord[..., :2]
@@ -523,11 +535,13 @@ def process_data_to_internal_format(data):
     other['traf'] = data['traffic_light']
 
     agent = copy.deepcopy(data['all_agent'])
-    data['all_agent'] = data['all_agent'][0:-1:gap]
-    data['lane'], other['unsampled_lane'] = transform_coordinate_map(data)
+    data['all_agent'] = data['all_agent'][0:-1:gap].copy()
+    other['lane'], other['unsampled_lane'] = transform_coordinate_map(data)
     data['traffic_light'] = data['traffic_light'][0:-1:gap]
 
-    other['lane'] = data['lane'][0]
+    # the map of every frame is cropped around the ego pose with a spatial index of the static map
+    lane_index = LaneIndex(data['lane'])
+    ego_pose = data['all_agent'][:, 0][:, [0, 1, 4]]
 
     # transform agent coordinate
     ego = agent[:, 0]
@@ -549,8 +563,8 @@ def process_data_to_internal_format(data):
     # process agent and lane data
     case_info["agent"], case_info["agent_mask"] = process_agent(data['all_agent'], False)
     case_info['center'], case_info['center_mask'], case_info['bound'], case_info['bound_mask'], \
-    case_info['cross'], case_info['cross_mask'], case_info['rest'], case_info['rest_mask'] = process_map(
-        data['lane'], data['traffic_light'], lane_range=RANGE, offest=0)
+    case_info['cross'], case_info['cross_mask'], case_info['rest'], case_info['rest_mask'] = lane_index.process_map(
+        ego_pose, data['traffic_light'], lane_range=RANGE, offest=0)
 
     # get vector-based representation
     get_vec_based_rep(case_info)
@@ -0,0 +1,175 @@
+import argparse
+import os
+
+import torch
+import torch.nn as nn
+
+from trafficgen.init.model.tg_init import initializer
+from trafficgen.traffic_generator.traffic_generator import TrafficGen
+from trafficgen.traffic_generator.utils.data_utils import collate_cases
+from trafficgen.utils.check_precision import act_input
+from trafficgen.utils.config import load_config_init
+
+TRAFFICGEN_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+CKPT_PATH = os.path.join(TRAFFICGEN_ROOT, "traffic_generator", "ckpt")
+
+# the inputs of the actuator graph, in this order, as given by process_case_to_input
+ACT_INPUTS = ['agent', 'agent_mask', 'center', 'center_mask', 'cross', 'cross_mask', 'bound', 'bound_mask']
+ACT_OUTPUTS = ['prob', 'velo', 'pos', 'heading']
+
+
+class InitGraph(nn.Module):
+    """
+    The tensor only methods of the initializer used by inference_batch, to be traced: the lane and agent encodings,
+    the agent context and the heads of a placement step with the vector probability after the sigmoid.
+    """
+    def __init__(self, model):
+        super(InitGraph, self).__init__()
+        self.model = model
+
+    def encode_lane(self, lane_inp):
+        return self.model.encode_lane(lane_inp)
+
+    def encode_agent(self, agent_feat):
+        return self.model.encode_agent(agent_feat)
+
+    def agent_context(self, agent_enc, agent_mask):
+        return self.model.agent_context(agent_enc, agent_mask)
+
+    def forward(self, lane_inp, lane_mask, lane_enc, context_agent, center):
+        feature = self.model.map_feature_extract(lane_inp, lane_mask, context_agent, lane_enc)
+        feature = feature[:, :center.shape[1]]
+        prob, *outputs = self.model.head_outputs(feature)
+        return (torch.sigmoid(prob), *outputs)
+
+
+class ActGraph(nn.Module):
+    """The actuator with the tensors of ACT_INPUTS as arguments and the tensors of ACT_OUTPUTS as result."""
+    def __init__(self, model):
+        super(ActGraph, self).__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        pred = self.model(dict(zip(ACT_INPUTS, inputs)))
+        return tuple(pred[key] for key in ACT_OUTPUTS)
+
+
+class GraphInitializer:
+    """
+    Runs inference_batch of the initializer on a graph with the methods of InitGraph: a graph traced by export_graphs,
+    InitGraph itself or a batched graph, the sampling of the agents stays in python. Only for inference, the random
+    mask of the training is not applied.
+    """
+    inference = initializer.inference
+    inference_batch = initializer.inference_batch
+    sample_candidates = initializer.sample_candidates
+    sample_from_distribution = initializer.sample_from_distribution
+    sample_free_space = initializer.sample_free_space
+
+    def __init__(self, graph, cfg):
+        self.graph = graph
+        self.cfg = cfg
+
+    def eval(self):
+        return self
+
+    def encode_lane(self, lane_inp):
+        return self.graph.encode_lane(lane_inp)
+
+    def encode_agent(self, agent_feat):
+        return self.graph.encode_agent(agent_feat)
+
+    def agent_context(self, agent_enc, agent_mask):
+        return self.graph.agent_context(agent_enc, agent_mask)
+
+    def forward(self, data, random_mask=True, lane_enc=None, context_agent=None):
+        if context_agent is None:
+            context_agent = self.agent_context(self.encode_agent(data['agent_feat']), data['agent_mask'])
+        if lane_enc is None:
+            lane_enc = self.encode_lane(data['lane_inp'])
+        outputs = self.graph(data['lane_inp'], data['lane_mask'], lane_enc, context_agent, data['center'])
+        return initializer.outputs_to_dists(*outputs)
+
+    __call__ = forward
+
+
+class GraphActuator:
+    """Runs a graph of the actuator like ActGraph, traced by export_graphs or not, on process_case_to_input inputs."""
+    def __init__(self, graph, device):
+        self.graph = graph
+        self.device = torch.device(device)
+
+    def eval(self):
+        return self
+
+    def __call__(self, data):
+        outputs = self.graph(*[data[key] for key in ACT_INPUTS])
+        return dict(zip(ACT_OUTPUTS, outputs))
+
+
+def init_example(init_model, batch):
+    """The example inputs of every traced method of InitGraph, from a washed batch of InitDataset."""
+    with torch.no_grad():
+        lane_enc = init_model.encode_lane(batch['lane_inp'])
+        agent_enc = init_model.encode_agent(batch['agent_feat'])
+        agent_mask = batch['agent_mask'].clone()
+        context_agent = init_model.agent_context(agent_enc, agent_mask)
+    return {
+        'encode_lane': (batch['lane_inp'], ),
+        'encode_agent': (batch['agent_feat'], ),
+        'agent_context': (agent_enc, agent_mask),
+        'forward': (batch['lane_inp'], batch['lane_mask'], lane_enc, context_agent, batch['center'])
+    }
+
+
+def export_graphs(init_model, act_model, init_batch, act_batch, path=CKPT_PATH):
+    """
+    Trace both models on the example batches and save them as init_graph.pt and act_graph.pt in path. The shapes are
+    not fixed by the examples, the graphs run on batches of any size on the device they were traced on.
+    """
+    init_model.eval()
+    act_model.eval()
+    # like LightningModule.to_torchscript, the trainer property raises without a trainer while the tracer inspects it
+    init_model._jit_is_scripting = act_model._jit_is_scripting = True
+    try:
+        with torch.no_grad():
+            init_graph = torch.jit.trace_module(InitGraph(init_model), init_example(init_model, init_batch))
+            act_graph = torch.jit.trace(ActGraph(act_model), tuple(act_batch[key] for key in ACT_INPUTS))
+    finally:
+        init_model._jit_is_scripting = act_model._jit_is_scripting = False
+    torch.jit.save(init_graph, os.path.join(path, "init_graph.pt"))
+    torch.jit.save(act_graph, os.path.join(path, "act_graph.pt"))
+
+
+def load_graph(name, cfg, path=CKPT_PATH):
+    """
+    Load a graph saved by export_graphs as drop-in replacement of the initializer (name 'init') or the actuator
+    ('act').
+    """
+    device = cfg['device']
+    graph = torch.jit.load(os.path.join(path, f"{name}_graph.pt"), map_location=device)
+    if name == 'init':
+        return GraphInitializer(graph, cfg)
+    return GraphActuator(graph, device)
+
+
+if __name__ == '__main__':
+    """
+    Usage: python traffic_generator/utils/export_graph.py
+    Trace init.ckpt and act.ckpt on the first scenario of the dataset and save init_graph.pt and act_graph.pt next to
+    them. Set torchscript: True in the config to generate with the graphs.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', '-c', type=str, default='local')
+    args = parser.parse_args()
+
+    cfg = load_config_init(args.config)
+    cfg['torchscript'] = False
+    tg = TrafficGen(cfg)
+    case = tg.data_loader.dataset[0]
+    init_batch = collate_cases([case])
+    tg.wash(init_batch)
+    # the actuator input of the ground truth agents at the first step
+    act_batch = act_input(tg, case['other'])
+    tg.wash(act_batch)
+    export_graphs(tg.init_model, tg.act_model, init_batch, act_batch)
@@ -0,0 +1,69 @@
+import collections
+import queue
+import threading
+
+
+def run_task(fn, *args, **kwargs):
+    """Run fn for its side effects, its result (draw returns the pyplot module) is not sent back."""
+    fn(*args, **kwargs)
+
+
+class TaskWindow:
+    """
+    Submits tasks to a process pool with at most max_pending of them unfinished, submit waits for the oldest ones
+    beyond that. Without pool the tasks run right away. Every stage of the pipeline uses its own window.
+    """
+    def __init__(self, pool=None, max_pending=8):
+        self.pool = pool
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+
+    def submit(self, fn, *args, **kwargs):
+        if self.pool is None:
+            fn(*args, **kwargs)
+            return
+        self.pending.append(self.pool.submit(run_task, fn, *args, **kwargs))
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft().result()
+
+    def join(self):
+        """Wait for all the submitted tasks, raise the error of a failed one."""
+        while self.pending:
+            self.pending.popleft().result()
+
+
+def pool_map(pool, fn, iterable, max_pending=8):
+    """Like pool.map with at most max_pending tasks ahead of the consumer, the results are yielded in order."""
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.submit(fn, *args))
+        if len(pending) > max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def background(iterable, maxsize=8):
+    """
+    Iterate over iterable in a background thread, at most maxsize items ahead of the consumer, so that a stage runs
+    while the next one consumes its output. An error of the iteration is raised in the consumer.
+    """
+    items = queue.Queue(maxsize)
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+            items.put((end, None))
+        except Exception as e:
+            items.put((end, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is end:
+            return
+        yield item
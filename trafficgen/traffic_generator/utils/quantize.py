@@ -0,0 +1,146 @@
+import argparse
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from trafficgen.traffic_generator.utils.data_utils import collate_cases
+from trafficgen.utils.utils import normalize_angle, setup_seed
+
+TRAFFICGEN_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+CKPT_PATH = os.path.join(TRAFFICGEN_ROOT, "traffic_generator", "ckpt")
+
+
+def quantize(model):
+    """A dynamically quantized copy of the model: the weights of every nn.Linear in int8, activations in fp32."""
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def export_quantized(model, path):
+    """Save the quantized model with the hyperparameters to rebuild it, it only runs on cpu."""
+    torch.save({'hparams': dict(model.hparams), 'state_dict': quantize(model.cpu()).state_dict()}, path)
+
+
+def load_quantized(model_class, path):
+    """Load a model saved by export_quantized, model_class is initializer or actuator."""
+    ckpt = torch.load(path, map_location='cpu', weights_only=False)
+    model = quantize(model_class(**ckpt['hparams']))
+    model.load_state_dict(ckpt['state_dict'])
+    return model
+
+
+def placement_mmd(init_model, tg, num, seed=0):
+    """
+    MMD between the placed agents and the agents of the data on the first num scenarios of the dataset of tg, a
+    TrafficGen, like test_init.
+    """
+    # only the report needs wandb and torchmetrics, TrafficGen.load_model only imports load_quantized
+    from trafficgen.utils.evaluation import MMD
+
+    mmd_metrics = {
+        'heading': MMD(device='cpu', kernel_mul=1.0, kernel_num=1),
+        'size': MMD(device='cpu', kernel_mul=1.0, kernel_num=1),
+        'speed': MMD(device='cpu', kernel_mul=1.0, kernel_num=1),
+        'position': MMD(device='cpu', kernel_mul=1.0, kernel_num=1)
+    }
+    setup_seed(seed)
+    with torch.no_grad():
+        dataset = tg.data_loader.dataset
+        for idx in range(min(num, len(dataset))):
+            batch = collate_cases([dataset[idx]])
+            tg.wash(batch)
+            pred_agent = init_model.inference(batch)['agent']
+            agent_num = len(pred_agent)
+            if agent_num <= 1:
+                continue
+            target_agent = batch['agent']
+            pred_agent = pred_agent[1:]
+            source = {
+                'heading': torch.tensor(normalize_angle(np.concatenate([x.heading for x in pred_agent], axis=0))),
+                'size': torch.tensor(np.concatenate([x.length_width for x in pred_agent], axis=0)),
+                'speed': torch.tensor(np.concatenate([x.velocity for x in pred_agent], axis=0)),
+                'position': torch.tensor(np.concatenate([x.position for x in pred_agent], axis=0))
+            }
+            target = {
+                'heading': normalize_angle(target_agent[0, 1:agent_num, [4]]),
+                'size': target_agent[0, 1:agent_num, 5:7],
+                'speed': target_agent[0, 1:agent_num, 2:4],
+                'position': target_agent[0, 1:agent_num, :2]
+            }
+            for attr, metri in mmd_metrics.items():
+                if torch.all(source[attr] == 0) and torch.all(target[attr] == 0):
+                    continue
+                metri.update(source[attr].float(), target[attr].float())
+    return {attr: metric.compute().item() for attr, metric in mmd_metrics.items()}
+
+
+def trajectory_error(act_model, tg, data_loader):
+    """Mean ade (pos_loss) and fde of act_loss over the data loader, washed by tg, like test_act."""
+    from trafficgen.act.model.tg_act import act_loss
+
+    ade = []
+    fde = []
+    with torch.no_grad():
+        for data in data_loader:
+            tg.wash(data)
+            loss, loss_dict = act_loss(act_model(data), data)
+            ade.append(loss_dict['pos_loss'].item())
+            fde.append(loss_dict['fde'].item())
+    return {'ade': np.mean(ade), 'fde': np.mean(fde)}
+
+
+def accuracy_report(models, quantized_models, tg, act_loader, num):
+    """
+    Print the placement MMD on the dataset of tg and the trajectory errors on act_loader of the fp32 and the int8
+    models side by side.
+    """
+    rows = []
+    times = []
+    for init_model, act_model in [models, quantized_models]:
+        start = time.time()
+        metrics = {'mmd_' + key: value for key, value in placement_mmd(init_model, tg, num).items()}
+        metrics.update(trajectory_error(act_model, tg, act_loader))
+        rows.append(metrics)
+        times.append(time.time() - start)
+
+    print(f'{"metric":14s} {"fp32":>10s} {"int8":>10s}')
+    for key in rows[0]:
+        print(f'{key:14s} {rows[0][key]:10.5f} {rows[1][key]:10.5f}')
+    print(f'{"time (s)":14s} {times[0]:10.2f} {times[1]:10.2f}')
+
+
+if __name__ == '__main__':
+    """
+    Usage: python traffic_generator/utils/quantize.py [--num 10]
+    Export init_int8.pt and act_int8.pt next to init.ckpt and act.ckpt and report the accuracy of the quantized models
+    against the originals. Set quantized: True in the config to generate with them.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', '-c', type=str, default='local')
+    parser.add_argument('--act_config', type=str, default='local')
+    parser.add_argument('--num', '-n', type=int, default=10)
+    args = parser.parse_args()
+
+    from torch.utils.data import DataLoader
+
+    from trafficgen.act.model.tg_act import actuator
+    from trafficgen.act.utils.act_dataset import actDataset
+    from trafficgen.init.model.tg_init import initializer
+    from trafficgen.traffic_generator.traffic_generator import TrafficGen
+    from trafficgen.utils.config import load_config_act, load_config_init
+
+    init_model = initializer.load_from_checkpoint(os.path.join(CKPT_PATH, "init.ckpt"), map_location='cpu').eval()
+    act_model = actuator.load_from_checkpoint(os.path.join(CKPT_PATH, "act.ckpt"), map_location='cpu').eval()
+    export_quantized(init_model, os.path.join(CKPT_PATH, "init_int8.pt"))
+    export_quantized(act_model, os.path.join(CKPT_PATH, "act_int8.pt"))
+    quantized_init = load_quantized(initializer, os.path.join(CKPT_PATH, "init_int8.pt"))
+    quantized_act = load_quantized(actuator, os.path.join(CKPT_PATH, "act_int8.pt"))
+
+    cfg = load_config_init(args.config)
+    cfg['device'] = 'cpu'
+    act_cfg = load_config_act(args.act_config)
+    act_loader = DataLoader(actDataset(act_cfg), batch_size=act_cfg['batch_size'], shuffle=False, num_workers=0)
+    accuracy_report((init_model, act_model), (quantized_init, quantized_act), TrafficGen(cfg), act_loader, args.num)
@@ -0,0 +1,299 @@
+import numpy as np
+import torch
+
+from trafficgen.utils.utils import rotate, lane_groups
+
+RANGE = 50
+MAX_SPEED = 30
+MAX_AGENT = 32
+
+
+def cal_rel_dir(dir1, dir2):
+    """Same as utils.cal_rel_dir, the angle from dir2 to dir1 in [-pi, pi]."""
+    dist = torch.remainder(dir1 - dir2, 2 * np.pi)
+    return torch.where(dist > np.pi, dist - 2 * np.pi, dist)
+
+
+def to_ego_frame(agent, ego):
+    """Transform agents in shape [b, n, >=5] to the frame of ego in shape [b, >=5], in place."""
+    ego_pos = ego[:, None, :2].clone()
+    ego_heading = ego[:, None, 4].clone()
+    agent[..., :2] = rotate(agent[..., 0] - ego_pos[..., 0], agent[..., 1] - ego_pos[..., 1], -ego_heading)
+    agent[..., 2:4] = rotate(agent[..., 2], agent[..., 3], -ego_heading)
+    agent[..., 4] -= ego_heading
+    return agent
+
+
+def process_agent(agent, sort_agent, generator=None):
+    """
+    Same as data_utils.process_agent. Agents in the same raster cell keep their original order, which may differ
+    from the unstable argsort of the numpy version, and the random permutation is drawn from torch.
+    """
+    to_ego_frame(agent, agent[:, 0])
+
+    agent_mask = agent[..., -1]
+    agent_type_mask = agent[..., -2] == 1
+    agent_range_mask = (abs(agent[..., 0]) < RANGE) * (abs(agent[..., 1]) < RANGE)
+    mask = (agent_mask * agent_type_mask * agent_range_mask) != 0
+
+    # raster sort: rows from top to bottom, left to right inside a row, invalid agents at the end
+    others, others_mask = agent[:, 1:], mask[:, 1:]
+    x = torch.floor(torch.where(others_mask, others[..., 0], torch.full_like(others[..., 0], 10e8)) / 0.25)
+    y = torch.floor(torch.where(others_mask, others[..., 1], torch.full_like(others[..., 1], -10e8)) / 0.25)
+    index = torch.sort(x, dim=-1, stable=True)[1]
+    index = index.gather(1, torch.sort(-y.gather(1, index), dim=-1, stable=True)[1])
+
+    sorted_agent = agent.clone()
+    sorted_mask = mask.clone()
+    sorted_agent[:, 1:] = others.gather(1, index[..., None].expand_as(others))
+    sorted_mask[:, 1:] = others_mask.gather(1, index)
+    sorted_mask[:, 0] = True
+
+    if not sort_agent:
+        # shuffle the valid agents after the ego agent, keep the rest in place
+        key = torch.rand(sorted_mask[:, 1:].shape, generator=generator, device=agent.device)
+        key = torch.where(sorted_mask[:, 1:], key, torch.full_like(key, 2))
+        index = torch.sort(key, dim=-1, stable=True)[1]
+        others = sorted_agent[:, 1:]
+        sorted_agent[:, 1:] = others.gather(1, index[..., None].expand_as(others))
+    return sorted_agent[..., :-1], sorted_mask
+
+
+def process_map(groups, pose, traf, center_num=384, edge_num=128, lane_range=60, offest=-40):
+    """
+    Same as LaneIndex.process_map, with every vector of the map transformed to the batch of poses in shape [b, 3]
+    on the device of pose, instead of querying the spatial index. groups are the lane_groups of the map, without the
+    trees of LaneIndex.
+    """
+    b = pose.shape[0]
+    device = pose.device
+    center = pose[:, None, :2]
+    yaw = pose[:, None, 2]
+
+    # traffic light of every timestep, padded to the same number of lights
+    light_num = max([len(traf_t) for traf_t in traf] + [1])
+    light = np.zeros([b, light_num, 2])
+    light[..., 0] = np.nan
+    for t, traf_t in enumerate(traf):
+        for i, a_traf in enumerate(traf_t):
+            light[t, i] = a_traf[0], a_traf[-2]
+    light = torch.tensor(light, dtype=pose.dtype, device=device)
+
+    output = []
+    for group, max_vec in zip(groups, [center_num, edge_num, 32, 192]):
+        vec = torch.zeros([b, max_vec, 6], dtype=pose.dtype, device=device)
+        vec_mask = torch.zeros([b, max_vec], dtype=torch.bool, device=device)
+        output += [vec, vec_mask]
+        if group['start'].shape[0] == 0:
+            continue
+
+        start = torch.tensor(group['start'], dtype=pose.dtype, device=device)[None] - center
+        end = torch.tensor(group['end'], dtype=pose.dtype, device=device)[None] - center
+        start = rotate(start[..., 0], start[..., 1], -yaw)
+        end = rotate(end[..., 0], end[..., 1], -yaw)
+
+        start_mask = (abs(start[..., 0] + offest) < lane_range) * (abs(start[..., 1]) < lane_range)
+        end_mask = (abs(end[..., 0] + offest) < lane_range) * (abs(end[..., 1]) < lane_range)
+        mask = start_mask * end_mask
+
+        # state of the last light controlling the lane of the vector, 0 without light
+        lane_id = torch.tensor(group['id'], dtype=pose.dtype, device=device)
+        match = light[..., 0, None] == lane_id[None, None]
+        light_idx = torch.arange(1, light_num + 1, device=device)[None, :, None]
+        last = torch.where(match, light_idx, torch.zeros_like(light_idx)).amax(1)
+        state = light[..., 1].gather(1, (last - 1).clamp(min=0)) * (last > 0)
+
+        lane_type = torch.tensor(group['type'], dtype=pose.dtype, device=device)[None].expand(b, -1)
+        vector = torch.cat([start, end, lane_type[..., None], state[..., None]], -1)
+
+        dist = start[..., 0]**2 + start[..., 1]**2
+        dist = torch.where(mask, dist, torch.full_like(dist, float('inf')))
+        index = torch.sort(dist, dim=-1, stable=True)[1][:, :max_vec]
+        num = index.shape[1]
+        vec_mask[:, :num] = mask.gather(1, index)
+        vec[:, :num] = vector.gather(1, index[..., None].expand(-1, -1, 6)) * vec_mask[:, :num, None]
+    return output
+
+
+def compact(mask, max_num, *arrays):
+    """Same as utils.compact for tensors."""
+    b, n = mask.shape
+    num = min(n, max_num)
+    order = torch.sort((~mask).to(torch.uint8), dim=1, stable=True)[1][:, :num]
+    new_mask = torch.zeros([b, max_num], dtype=torch.bool, device=mask.device)
+    new_mask[:, :num] = mask.gather(1, order)
+
+    output = []
+    for arr in arrays:
+        new_arr = torch.zeros([b, max_num, *arr.shape[2:]], dtype=arr.dtype, device=arr.device)
+        index = order.reshape(b, num, *[1] * (arr.dim() - 2)).expand(-1, -1, *arr.shape[2:])
+        new_arr[:, :num] = arr.gather(1, index)
+        new_arr[~new_mask] = 0
+        output.append(new_arr)
+    return output, new_mask
+
+
+def get_vec_based_rep(case_info):
+    """Same as data_utils.get_vec_based_rep."""
+    thres = 5
+
+    agent = case_info['agent']
+    vectors = case_info['center']
+    agent_mask = case_info['agent_mask']
+
+    # nearest center lane vector of every agent
+    vec_x = ((vectors[..., 0] + vectors[..., 2]) / 2)[:, None]
+    vec_y = ((vectors[..., 1] + vectors[..., 3]) / 2)[:, None]
+    dist = torch.sqrt((vec_x - agent[..., 0, None])**2 + (vec_y - agent[..., 1, None])**2)
+    dist = torch.where(case_info['center_mask'][:, None], dist, torch.full_like(dist, 10e5))
+    min_dist_to_lane, vec_index = dist.min(-1)
+    min_dist_mask = min_dist_to_lane < thres
+
+    the_vec = vectors.gather(1, vec_index[..., None].expand(-1, -1, vectors.shape[-1]))
+
+    vx, vy = agent[..., 2], agent[..., 3]
+    v_value = torch.sqrt(vx**2 + vy**2)
+    low_vel = v_value < 0.1
+
+    dir_v = torch.atan2(vy, vx)
+    x1, y1, x2, y2 = the_vec[..., 0], the_vec[..., 1], the_vec[..., 2], the_vec[..., 3]
+    dir = torch.atan2(y2 - y1, x2 - x1)
+    agent_dir = agent[..., 4]
+
+    v_relative_dir = cal_rel_dir(dir_v, agent_dir)
+    relative_dir = cal_rel_dir(agent_dir, dir)
+    v_relative_dir[low_vel] = 0
+
+    v_dir_mask = abs(v_relative_dir) < np.pi / 6
+    dir_mask = abs(relative_dir) < np.pi / 4
+
+    coord = rotate(agent[..., 0] - (x1 + x2) / 2, agent[..., 1] - (y1 + y2) / 2, np.pi / 2 - dir)
+    vec_len = torch.clamp(torch.sqrt((y2 - y1)**2 + (x1 - x2)**2), min=4.5, max=5.5)
+    lat_perc = torch.maximum(torch.minimum(coord[..., 0], vec_len / 2), -vec_len / 2) / vec_len
+    long_perc = torch.maximum(torch.minimum(coord[..., 1], vec_len / 2), -vec_len / 2) / vec_len
+
+    total_mask = min_dist_mask * agent_mask * v_dir_mask * dir_mask
+    total_mask[:, 0] = True
+
+    info = torch.cat(
+        [
+            vec_index[..., None].to(agent.dtype), long_perc[..., None], lat_perc[..., None], v_value[..., None],
+            v_relative_dir[..., None], relative_dir[..., None], the_vec
+        ], -1
+    )
+    (agent_, info_), agent_mask_ = compact(total_mask, MAX_AGENT, agent, info)
+
+    case_info['vec_based_rep'] = info_[..., 1:]
+    case_info['agent_vec_index'] = info_[..., 0].long()
+    case_info['agent_mask'] = agent_mask_
+    case_info['agent'] = agent_
+
+
+def get_agent_feat(agent, vec_based_rep):
+    """Same as WaymoAgent(agent, vec_based_rep).get_inp()."""
+    vec_based_rep = vec_based_rep.clone()
+    vec_based_rep[..., 5:9] /= RANGE
+    vec_based_rep[..., 2] /= MAX_SPEED
+    return torch.cat(
+        [
+            agent[..., :2] / RANGE, agent[..., 2:4] / MAX_SPEED,
+            torch.cos(agent[..., 4:5]),
+            torch.sin(agent[..., 4:5]), agent[..., 5:7], vec_based_rep
+        ], -1
+    )
+
+
+def get_gt(case_info):
+    """Same as data_utils.get_gt, when several agents are on the same vector the later one is kept."""
+    center_num = case_info['center'].shape[1]
+    index = case_info['agent_vec_index']
+    vec_based_rep = case_info['vec_based_rep']
+    bbox = case_info['agent'][..., 5:7]
+    agent_mask = case_info['agent_mask']
+
+    b, agent_num = index.shape
+    device = index.device
+    # the last agent slot written to every vector, -1 for none
+    slot = torch.arange(agent_num, device=device)[None].expand(b, -1)
+    last = torch.full([b, center_num], -1, dtype=torch.long, device=device)
+    last.scatter_reduce_(1, index, slot, reduce='amax')
+    written = last >= 0
+    last = last.clamp(min=0)
+
+    gt_vec_based_coord = vec_based_rep[..., :5].gather(1, last[..., None].expand(-1, -1, 5)) * written[..., None]
+    gt_bbox = bbox.gather(1, last[..., None].expand(-1, -1, 2)) * written[..., None]
+    gt_distribution = torch.zeros([b, center_num], dtype=vec_based_rep.dtype, device=device)
+    gt_distribution.scatter_add_(1, index, agent_mask.to(vec_based_rep.dtype))
+    gt_distribution = (gt_distribution > 0).to(vec_based_rep.dtype)
+
+    case_info['gt_bbox'] = gt_bbox
+    case_info['gt_distribution'] = gt_distribution
+    case_info['gt_long_lat'] = gt_vec_based_coord[..., :2]
+    case_info['gt_speed'] = gt_vec_based_coord[..., 2]
+    case_info['gt_vel_heading'] = gt_vec_based_coord[..., 3]
+    case_info['gt_heading'] = gt_vec_based_coord[..., 4]
+
+
+def process_data_to_internal_format(data, device='cpu', dtype=torch.float32, generator=None):
+    """
+    Torch version of data_utils.process_data_to_internal_format. The same transforms run on device in dtype and the
+    outputs are tensors on device, ready to be fed to the initializer without wash. Selected with
+    preprocess_backend: 'torch' in the config.
+    """
+    case_info = {}
+    gap = 20
+    other = {}
+
+    other['traf'] = data['traffic_light']
+    traffic_light = data['traffic_light'][0:-1:gap]
+
+    all_agent = torch.tensor(np.asarray(data['all_agent']), dtype=dtype, device=device)
+    agent = all_agent.clone()
+    sampled_agent = all_agent[0:-1:gap].clone()
+    ego_pose = sampled_agent[:, 0][:, [0, 1, 4]]
+
+    # lane and unsampled lane in the ego frame of the first frame
+    ego = all_agent[[0], 0]
+    for key in ['lane', 'unsampled_lane']:
+        lane = torch.tensor(np.asarray(data[key]), dtype=dtype, device=device)[None]
+        lane[..., :2] = rotate(lane[..., 0] - ego[:, None, 0], lane[..., 1] - ego[:, None, 1], -ego[:, None, 4])
+        other[key] = lane[0]
+
+    # transform agent coordinate
+    to_ego_frame(agent, agent[0, [0]].expand(agent.shape[0], -1))
+    agent_range_mask = (abs(agent[..., 0]) < RANGE) * (abs(agent[..., 1]) < RANGE)
+    other['gt_agent'] = agent[..., :7]
+    other['gt_agent_mask'] = agent[..., -1] * agent[..., -2] * agent_range_mask
+
+    # process agent and lane data
+    case_info['agent'], case_info['agent_mask'] = process_agent(sampled_agent, False, generator)
+    case_info['center'], case_info['center_mask'], case_info['bound'], case_info['bound_mask'], \
+    case_info['cross'], case_info['cross_mask'], case_info['rest'], case_info['rest_mask'] = process_map(
+        lane_groups(data['lane']), ego_pose, traffic_light, lane_range=RANGE, offest=0)
+
+    get_vec_based_rep(case_info)
+    case_info['agent_feat'] = get_agent_feat(case_info['agent'], case_info['vec_based_rep'])
+
+    lane_inp = []
+    for key in ['center', 'bound', 'cross', 'rest']:
+        lane = case_info[key].clone()
+        lane[..., :4] /= RANGE
+        lane_inp.append(lane)
+    case_info['lane_inp'] = torch.cat(lane_inp, 1)
+    case_info['lane_mask'] = torch.cat(
+        [case_info['center_mask'], case_info['bound_mask'], case_info['cross_mask'], case_info['rest_mask']], 1
+    )
+
+    get_gt(case_info)
+
+    case_num = case_info['agent'].shape[0]
+    case_list = []
+    for i in range(case_num):
+        dic = {}
+        for k, v in case_info.items():
+            dic[k] = v[i]
+        case_list.append(dic)
+
+    case_list[0]['other'] = other
+
+    return case_list
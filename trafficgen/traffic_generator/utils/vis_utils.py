@@ -4,6 +4,9 @@ import matplotlib.pyplot as plt
 matplotlib.rcParams.update({'figure.max_open_warning': 0})
 import matplotlib.colors as mcolors
 import matplotlib.cm as cm
+import numpy as np
+
+from trafficgen.utils.utils import box_intersect
 
 
 def draw(center, agents, other, heat_map=None, save=False, edge=None, path='../vis', abn_idx=None, vis_range=60):
@@ -97,20 +100,15 @@ def draw_seq(center, agents, traj=None, other=None, heat_map=False, save=False,
     fig, ax = plt.subplots(figsize=(10, 10))
     plt.axis('equal')
 
-    shapes = []
+    # an agent collides if it overlaps one of the earlier agents that do not collide
+    boxes = np.stack([agent.get_rect(pad=0.25)[0] for agent in agents])
+    intersect = box_intersect(boxes, boxes)
     collide = []
-    poly = agents[0].get_polygon()[0]
-    shapes.append(poly)
+    kept = np.ones(len(agents), dtype=bool)
     for i in range(1, len(agents)):
-        intersect = False
-        poly = agents[i].get_polygon()[0]
-        for shape in shapes:
-            if poly.intersects(shape):
-                intersect = True
-                collide.append(i)
-                break
-        if not intersect:
-            shapes.append(poly)
+        if intersect[i, :i][kept[:i]].any():
+            kept[i] = False
+            collide.append(i)
 
     colors = list(mcolors.TABLEAU_COLORS)
     lane_color = 'black'
@@ -0,0 +1,85 @@
+import bisect
+import collections
+import hashlib
+import json
+import os
+import pickle
+
+
+def _atomic_write(path, content):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+
+class ShardedCache:
+    """
+    Processed cases of a dataset, saved in shards of shard_size source files as
+    cache_path/{fingerprint}/{start}_{end}.pkl, with the number of cases in {start}_{end}.len.
+
+    The fingerprint is a hash of the config entries the processing depends on, so changing one of them invalidates the
+    whole cache, while changing data_usage only builds the shards that are missing. Shards are loaded when a case in
+    them is requested and at most max_shards of them are kept in memory, the least recently used one is evicted.
+    """
+    def __init__(self, cache_path, cfg, keys, shard_size=16, max_shards=4):
+        fingerprint = json.dumps({key: cfg[key] for key in keys}, sort_keys=True)
+        fingerprint = hashlib.md5(fingerprint.encode()).hexdigest()[:8]
+        self.shard_path = os.path.join(cache_path, fingerprint)
+        os.makedirs(self.shard_path, exist_ok=True)
+
+        self.shard_size = shard_size
+        self.max_shards = max_shards
+        self.shard_list = []
+        self.case_offset = [0]
+        self.loaded = collections.OrderedDict()
+
+    def shards(self, data_usage):
+        """The (start, end) source file ranges of the shards covering the first data_usage files."""
+        return [(start, min(start + self.shard_size, data_usage)) for start in range(0, data_usage, self.shard_size)]
+
+    def _file(self, shard, ext):
+        return os.path.join(self.shard_path, '{}_{}.{}'.format(*shard, ext))
+
+    def exists(self, shard):
+        # the .len file is written last, a shard without it is incomplete
+        return os.path.exists(self._file(shard, 'len'))
+
+    def save(self, shard, cases):
+        """Save the list of cases processed from the files of the shard. Safe to call from worker processes."""
+        _atomic_write(self._file(shard, 'pkl'), pickle.dumps(cases))
+        _atomic_write(self._file(shard, 'len'), str(len(cases)).encode())
+        return len(cases)
+
+    def open(self, data_usage):
+        """Index the cases of the shards covering the first data_usage files, all of them have to exist."""
+        self.shard_list = self.shards(data_usage)
+        self.case_offset = [0]
+        for shard in self.shard_list:
+            with open(self._file(shard, 'len')) as f:
+                self.case_offset.append(self.case_offset[-1] + int(f.read()))
+        self.loaded.clear()
+
+    def __len__(self):
+        return self.case_offset[-1]
+
+    def _load(self, shard_idx):
+        if shard_idx in self.loaded:
+            self.loaded.move_to_end(shard_idx)
+        else:
+            with open(self._file(self.shard_list[shard_idx], 'pkl'), 'rb') as f:
+                self.loaded[shard_idx] = pickle.load(f)
+            if len(self.loaded) > self.max_shards:
+                self.loaded.popitem(last=False)
+        return self.loaded[shard_idx]
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        shard_idx = bisect.bisect_right(self.case_offset, index) - 1
+        return self._load(shard_idx)[index - self.case_offset[shard_idx]]
+
+    def __getstate__(self):
+        # DataLoader workers start with an empty LRU instead of a copy of the loaded shards
+        state = self.__dict__.copy()
+        state['loaded'] = collections.OrderedDict()
+        return state
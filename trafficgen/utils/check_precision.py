@@ -0,0 +1,111 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from trafficgen.traffic_generator.traffic_generator import TrafficGen, to_numpy
+from trafficgen.traffic_generator.utils.data_utils import collate_cases, transform_to_agents, process_cases_to_input
+from trafficgen.utils.config import load_config_init
+from trafficgen.utils.utils import LaneIndex, inference_autocast
+
+
+def run(model, batch, device, precision, forward):
+    with torch.no_grad(), inference_autocast(device, precision):
+        start = time.time()
+        pred = forward(model, batch)
+        return pred, time.time() - start
+
+
+def placement_drift(init_model, batch, device, precision):
+    """Drift of the placement distributions of a batch in the reduced precision against fp32."""
+    forward = lambda model, batch: model.forward(batch, False)
+    ref, ref_time = run(init_model, batch, device, 'fp32', forward)
+    pred, pred_time = run(init_model, batch, device, precision, forward)
+
+    mask = batch['center_mask']
+    # the lane vector is drawn in proportion to prob, compare the normalized distributions
+    ref_prob = ref['prob'] * mask
+    prob = pred['prob'] * mask
+    ref_lane = ref_prob / ref_prob.sum(-1, keepdim=True)
+    lane = prob / prob.sum(-1, keepdim=True)
+
+    drift = {}
+    drift['prob'] = (prob - ref_prob).abs().max().item()
+    drift['lane_tv'] = 0.5 * (lane - ref_lane).abs().sum(-1).max().item()
+    for key in ['pos', 'bbox', 'heading']:
+        drift[key + '_mean'] = (pred[key].mean - ref[key].mean)[mask].abs().max().item()
+    for key in ['speed', 'vel_heading']:
+        drift[key] = (pred[key] - ref[key])[mask].abs().max().item()
+    return drift, ref_time, pred_time
+
+
+def trajectory_drift(act_model, batch, device, precision):
+    """Drift of the most probable trajectory of every agent in the reduced precision against fp32."""
+    forward = lambda model, batch: model(batch)
+    ref, ref_time = run(act_model, batch, device, 'fp32', forward)
+    pred, pred_time = run(act_model, batch, device, precision, forward)
+
+    ref_traj = TrafficGen.select_best_traj(ref)
+    traj = TrafficGen.select_best_traj(pred)
+    drift = {}
+    drift['endpoint'] = np.linalg.norm(traj[:, -1, :2] - ref_traj[:, -1, :2], axis=-1).max()
+    drift['same_mode'] = (pred['prob'].argmax(-1) == ref['prob'].argmax(-1)).float().mean().item()
+    return drift, ref_time, pred_time
+
+
+def act_input(tg, other):
+    """Actuator input of the ground truth agents of a scenario at the first step, like inference_control_batch."""
+    gt_agent = to_numpy(other['gt_agent'])
+    gt_agent_mask = to_numpy(other['gt_agent_mask']).astype(bool)
+    # [agent_num, 8] with a zero type column, like the rollout state
+    current_agent = np.zeros([gt_agent_mask[0].sum(), 8])
+    current_agent[:, :7] = gt_agent[0][gt_agent_mask[0]]
+    agent, _ = transform_to_agents(current_agent)
+    pose = current_agent[:, [0, 1, 4]]
+    inp = process_cases_to_input(agent, LaneIndex(to_numpy(other['lane'])), other['traf'][0], pose=pose)
+    return {key: Tensor(value) for key, value in inp.items()}
+
+
+def check_precision(tg, precision, num):
+    """Report the worst drift over the first num scenarios of the dataset and the time of both precisions."""
+    device = tg.cfg['device']
+    tg.init_model.eval()
+    tg.act_model.eval()
+    dataset = tg.data_loader.dataset
+
+    for name, model, drift_fn, get_input in [
+        ('placement', tg.init_model, placement_drift, lambda case: collate_cases([case])),
+        ('trajectory', tg.act_model, trajectory_drift, lambda case: act_input(tg, case['other'])),
+    ]:
+        worst = {}
+        times = np.zeros(2)
+        for idx in range(min(num, len(dataset))):
+            batch = get_input(dataset[idx])
+            tg.wash(batch)
+            drift, ref_time, pred_time = drift_fn(model, batch, device, precision)
+            for key, value in drift.items():
+                # same_mode is an agreement rate, the worst is the lowest
+                worst[key] = min(worst.get(key, 1), value) if key == 'same_mode' else max(worst.get(key, 0), value)
+            times += [ref_time, pred_time]
+        print(f'{name} drift of {precision} against fp32 over {min(num, len(dataset))} scenarios:')
+        for key, value in worst.items():
+            print(f'  {key:12s} {value:.6f}')
+        print(f'  time fp32 {times[0]:.3f}s, {precision} {times[1]:.3f}s, speedup {times[0] / times[1]:.2f}x')
+
+
+if __name__ == '__main__':
+    """
+    Usage: python utils/check_precision.py --precision bf16 --num 10
+    Run both models in fp32 and in the reduced precision on the same inputs and report how far the placement
+    distributions and the trajectory endpoints move, before switching inference_precision in the config.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', '-c', type=str, default='local')
+    parser.add_argument('--precision', '-p', type=str, default='bf16', choices=['bf16', 'fp16'])
+    parser.add_argument('--num', '-n', type=int, default=10)
+    args = parser.parse_args()
+
+    cfg = load_config_init(args.config)
+    check_precision(TrafficGen(cfg), args.precision, args.num)
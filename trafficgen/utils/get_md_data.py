@@ -329,7 +329,8 @@ if __name__ == '__main__':
     from trafficgen.traffic_generator.utils.data_utils import process_data_to_internal_format
 
     cfg = load_config_init(args.config)
-    cfg["device"] = "cuda" if torch.cuda.is_available() else "cpu"
+    # the int8 models only run on cpu
+    cfg["device"] = "cuda" if torch.cuda.is_available() and not cfg.get('quantized', False) else "cpu"
     model = TrafficGen(cfg)
 
     batch = []
@@ -0,0 +1,163 @@
+import argparse
+import functools
+import json
+import os
+import pickle
+
+import numpy as np
+from tqdm import tqdm
+
+META_FILE = 'meta.json'
+
+
+class _ColumnWriter:
+    """Append arrays with the same row shape to a raw binary column, and record the row offset of every append."""
+    def __init__(self, store_path, name, dtype):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.f = open(os.path.join(store_path, name + '.bin'), 'wb')
+        self.row_shape = None
+        self.offset = [0]
+
+    def append(self, arr):
+        arr = np.ascontiguousarray(arr, dtype=self.dtype)
+        if self.row_shape is None:
+            self.row_shape = arr.shape[1:]
+        elif arr.shape[1:] != self.row_shape:
+            raise ValueError(f'{self.name}: row shape {arr.shape[1:]} does not match {self.row_shape}')
+        arr.tofile(self.f)
+        self.offset.append(self.offset[-1] + arr.shape[0])
+
+    def close(self):
+        self.f.close()
+        return {'dtype': self.dtype.str, 'shape': [self.offset[-1], *(self.row_shape or ())]}
+
+
+def build_store(pkl_path, store_path, data_usage=None):
+    """
+    Convert the scenario pickles pkl_path/{idx}.pkl (the output of trans20.py) to a columnar scenario store.
+    Every column is a raw binary file read with np.memmap, the ragged parts are indexed by offset columns:
+        all_agent       [agent, 190, 9], agent-major so the agents of one scenario are contiguous
+        lane            [point, 4]
+        unsampled_lane  [point, 4]
+        traffic_light   [light, 6], the lights of all steps, traffic_light_step holds the first light of every step
+        center_info     pickled bytes of the center_info dict of every scenario
+    """
+    if data_usage is None:
+        data_usage = len([file for file in os.listdir(pkl_path) if file.endswith('.pkl') and file[:-4].isdigit()])
+    os.makedirs(store_path, exist_ok=True)
+
+    writers = {
+        'all_agent': _ColumnWriter(store_path, 'all_agent', np.float64),
+        'lane': _ColumnWriter(store_path, 'lane', np.float64),
+        'unsampled_lane': _ColumnWriter(store_path, 'unsampled_lane', np.float64),
+        'traffic_light': _ColumnWriter(store_path, 'traffic_light', np.float64),
+        'center_info': _ColumnWriter(store_path, 'center_info', np.uint8),
+    }
+    ids = []
+    step_offset = [0]
+    traffic_light_offset = [0]
+    for idx in tqdm(range(data_usage)):
+        with open(os.path.join(pkl_path, f'{idx}.pkl'), 'rb') as f:
+            scene = pickle.load(f)
+        ids.append(scene['id'])
+        writers['all_agent'].append(scene['all_agent'].swapaxes(0, 1))
+        writers['lane'].append(scene['lane'])
+        writers['unsampled_lane'].append(scene['unsampled_lane'])
+        for step in scene['traffic_light']:
+            writers['traffic_light'].append(np.array(step).reshape(-1, 6))
+            step_offset.append(writers['traffic_light'].offset[-1])
+        traffic_light_offset.append(len(step_offset) - 1)
+        center_info = pickle.dumps(scene['center_info'], protocol=pickle.HIGHEST_PROTOCOL)
+        writers['center_info'].append(np.frombuffer(center_info, dtype=np.uint8))
+
+    columns = {}
+    offsets = {name + '_offset': writer.offset for name, writer in writers.items()}
+    offsets['traffic_light_offset'] = traffic_light_offset
+    offsets['traffic_light_step'] = step_offset
+    for name, writer in writers.items():
+        columns[name] = writer.close()
+    for name, offset in offsets.items():
+        writer = _ColumnWriter(store_path, name, np.int64)
+        writer.append(np.array(offset, dtype=np.int64))
+        columns[name] = writer.close()
+
+    # the meta file is written last, a store without it is incomplete
+    with open(os.path.join(store_path, META_FILE), 'w') as f:
+        json.dump({'ids': ids, 'columns': columns}, f)
+    return data_usage
+
+
+class ScenarioStore:
+    """
+    Read only view of a store written by build_store. store[idx] returns the same dict as loading {idx}.pkl, but the
+    arrays are slices of the memory-mapped columns, nothing is copied until it is read. The arrays are read only,
+    copy them before changing them in place.
+    """
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, META_FILE)) as f:
+            meta = json.load(f)
+        self.ids = meta['ids']
+        self.columns = {}
+        for name, info in meta['columns'].items():
+            shape = tuple(info['shape'])
+            if shape[0] == 0:
+                # an empty file can not be memory-mapped
+                self.columns[name] = np.zeros(shape, dtype=info['dtype'])
+            else:
+                path = os.path.join(store_path, name + '.bin')
+                self.columns[name] = np.memmap(path, dtype=info['dtype'], mode='r', shape=shape)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _rows(self, name, idx):
+        start, end = self.columns[name + '_offset'][idx:idx + 2]
+        return self.columns[name][start:end]
+
+    def __getitem__(self, idx):
+        scene = {}
+        scene['id'] = self.ids[idx]
+        scene['all_agent'] = self._rows('all_agent', idx).swapaxes(0, 1)
+        scene['lane'] = self._rows('lane', idx)
+        scene['unsampled_lane'] = self._rows('unsampled_lane', idx)
+
+        start, end = self.columns['traffic_light_offset'][idx:idx + 2]
+        step = self.columns['traffic_light_step'][start:end + 1]
+        traffic_light = self.columns['traffic_light']
+        scene['traffic_light'] = [traffic_light[step[t]:step[t + 1]] for t in range(end - start)]
+
+        scene['center_info'] = pickle.loads(self._rows('center_info', idx).tobytes())
+        return scene
+
+
+def is_scenario_store(data_path):
+    return os.path.exists(os.path.join(data_path, META_FILE))
+
+
+@functools.lru_cache(maxsize=None)
+def open_store(store_path):
+    return ScenarioStore(store_path)
+
+
+def load_scenario(data_path, idx):
+    """Load scenario idx from data_path, which is either a scenario store or a directory of {idx}.pkl files."""
+    if is_scenario_store(data_path):
+        return open_store(os.path.abspath(data_path))[idx]
+    with open(os.path.join(data_path, f'{idx}.pkl'), 'rb+') as f:
+        return pickle.load(f)
+
+
+if __name__ == '__main__':
+    """
+    Usage: python utils/scenario_store.py PROCESSED_DATA_PATH STORE_PATH
+    Then set 'data_path' in init/configs and act/configs to STORE_PATH.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pkl_path', type=str)
+    parser.add_argument('store_path', type=str)
+    parser.add_argument('--data_usage', type=int, default=None)
+    args = parser.parse_args()
+
+    scenario_num = build_store(args.pkl_path, args.store_path, args.data_usage)
+    print(f'{scenario_num} scenarios are saved to {args.store_path}')
@@ -0,0 +1,63 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+TRAFFICGEN_ROOT = os.path.dirname(os.path.dirname(__file__))
+
+# run in a fresh interpreter, so that nothing is imported yet, and print the time of every stage as json
+STARTUP = '''
+import json, sys, time
+start = time.time()
+times = {}
+from trafficgen.traffic_generator.traffic_generator import TrafficGen
+from trafficgen.utils.config import load_config_init
+times['import'] = time.time() - start
+cfg = load_config_init(sys.argv[1])
+tg = TrafficGen(cfg)
+times['TrafficGen'] = time.time() - start
+if 'init' in sys.argv[2:]:
+    tg.init_model
+    times['init_model'] = time.time() - start
+if 'act' in sys.argv[2:]:
+    tg.act_model
+    times['act_model'] = time.time() - start
+print(json.dumps(times))
+'''
+
+
+def startup_times(config, models, repeat):
+    """The time from the start of the interpreter to the end of every stage, for repeat fresh interpreters."""
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', STARTUP, config, *models],
+                             cwd=TRAFFICGEN_ROOT,
+                             env=dict(os.environ, PYTHONPATH=os.path.dirname(TRAFFICGEN_ROOT)),
+                             capture_output=True,
+                             text=True)
+        if out.returncode != 0:
+            raise RuntimeError(out.stderr)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return runs
+
+
+if __name__ == '__main__':
+    """
+    Usage: python utils/startup_benchmark.py [--models init act] [--repeat 5]
+    Time the startup of generate.py in fresh interpreters: importing TrafficGen, building it with the dataset and
+    loading the models, which happens on their first use.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', '-c', type=str, default='local')
+    parser.add_argument('--models', nargs='*', default=['init', 'act'], choices=['init', 'act'])
+    parser.add_argument('--repeat', '-r', type=int, default=5)
+    args = parser.parse_args()
+
+    runs = startup_times(args.config, args.models, args.repeat)
+    print(f'startup over {args.repeat} runs, seconds since the interpreter started:')
+    for stage in runs[0]:
+        times = [run[stage] for run in runs]
+        print(f'  {stage:12s} median {np.median(times):.3f}  min {np.min(times):.3f}')
@@ -1,4 +1,5 @@
-import sys
+import argparse
+import multiprocessing
 
 from tqdm import tqdm
 
@@ -10,7 +11,9 @@ import scenario_pb2
 import os
 import pickle
 import numpy as np
-from enum import Enum
+
+# the workers pickle the types, keep them in an importable module rather than in __main__ of the script
+from trafficgen.utils.typedef import RoadLineType
 
 SAMPLE_NUM = 10
 LANE_DIM = 4
@@ -28,35 +31,6 @@ def yaw_to_y(angles):
     return np.array(ret)
 
 
-class RoadLineType(Enum):
-    UNKNOWN = 0
-    BROKEN_SINGLE_WHITE = 1
-    SOLID_SINGLE_WHITE = 2
-    SOLID_DOUBLE_WHITE = 3
-    BROKEN_SINGLE_YELLOW = 4
-    BROKEN_DOUBLE_YELLOW = 5
-    SOLID_SINGLE_YELLOW = 6
-    SOLID_DOUBLE_YELLOW = 7
-    PASSING_DOUBLE_YELLOW = 8
-
-    @staticmethod
-    def is_road_line(line):
-        return True if line.__class__ == RoadLineType else False
-
-    @staticmethod
-    def is_yellow(line):
-        return True if line in [
-            RoadLineType.SOLID_DOUBLE_YELLOW, RoadLineType.PASSING_DOUBLE_YELLOW, RoadLineType.SOLID_SINGLE_YELLOW,
-            RoadLineType.BROKEN_DOUBLE_YELLOW, RoadLineType.BROKEN_SINGLE_YELLOW
-        ] else False
-
-    @staticmethod
-    def is_broken(line):
-        return True if line in [
-            RoadLineType.BROKEN_DOUBLE_YELLOW, RoadLineType.BROKEN_SINGLE_YELLOW, RoadLineType.BROKEN_SINGLE_WHITE
-        ] else False
-
-
 def yaw_to_theta(angles, thetas):
     """
     In time horizon
@@ -104,19 +78,16 @@ def extract_tracks(f, sdc_index):
     # sdc_theta = yaw_to_y(sdc_yaw).astype(np.float32)
 
     for i in range(len(f)):
-        f_item = f[i]
-        x = np.array([state.center_x for state in f[i].states])
-        y = np.array([state.center_y for state in f[i].states])
-        # pos = np.concatenate([np.expand_dims(x, -1), np.expand_dims(y, -1)], axis=-1)
-        l = np.array([[state.length] for state in f[i].states])[:, 0]
-        w = np.array([[state.width] for state in f[i].states])[:, 0]
-        head = np.array([state.heading for state in f[i].states])
-        vx = np.array([state.velocity_x for state in f[i].states])
-        vy = np.array([state.velocity_y for state in f[i].states])
-        valid = np.array([[state.valid] for state in f[i].states])[:, 0]
-        t = np.repeat(f[i].object_type, len(valid))
-        agents[i] = np.stack((x, y, vx, vy, head, l, w, t, valid), axis=-1)[:BATCH_SIZE]
-        # agents[i] = np.concatenate((pos, velocity, head, l, w, t, valid), axis=-1)[:BATCH_SIZE]
+        track = f[i]
+        # one pass over the states, columns: x, y, vx, vy, head, l, w, t, valid
+        agents[i] = np.array(
+            [
+                (
+                    state.center_x, state.center_y, state.velocity_x, state.velocity_y, state.heading, state.length,
+                    state.width, track.object_type, state.valid
+                ) for state in track.states
+            ]
+        )[:BATCH_SIZE]
 
     ego = agents[[sdc_index]]
     others = np.delete(agents, sdc_index, axis=0)
@@ -403,144 +374,166 @@ def compute_width(scene):
     return
 
 
-def parse_data(inut_path, output_path, pre_fix=None):
-    MAX = 100000
-    cnt = 0
+PART_DIR = '.parts'
+
+
+def parse_scenario(scenario):
+    '''
+    For param scenario:
+    01. scenario_id - 
+        A unique string identifier for this scenario.
+    02. timestamps_seconds - 
+        Repeated field containing timestamps for each step in the Scenario starting at zero.
+    03. tracks - 
+        Repeated field containing tracks for each object.
+    04. id - 
+        A unique numeric ID for each object.
+    05. object_type - 
+        The type of object for this track (vehicle, pedestrian, or cyclist).
+    06. states - 
+        Repeated field containing the state of the object for each time step containing its 3D position, 
+        velocity, heading, dimensions, and a valid flag. This field corresponds to the top level 
+        timestamps_seconds field such that tracks[i].states[j] indexes the ith agent's state at time 
+        timestamps_seconds[j]
+    07. dynamic_map_states - 
+        Repeated field containing traffic signal states across time steps such that dynamic_map_states[i] 
+        occurs at timestamps_seconds[i]
+    08. lane_states - 
+        Repeated field containing the set of traffic signal states and the IDs of lanes they control 
+        (indexes into the map_features field) for a given time step.
+    09. map_features - 
+        Repeated field containing the set of map data for the scenario. This includes lane centers, 
+        lane boundaries, road boundaries, crosswalks, speed bumps, and stop signs. Map features are 
+        defined as 3D polylines or polygons. See the map proto definitions for full details.
+    10. sdc_track_index - 
+        The track index of the autonomous vehicle in the scene.
+    11. objects_of_interest - 
+        Repeated field containing indices into the tracks field of objects determined to have behavior that 
+        may be useful for research training.
+    12. tracks_to_predict - 
+        Repeated field containing a set of indices into the tracks field indicating which objects must be 
+        predicted. This field is provided in the training and validation sets only. These are selected to 
+        include interesting behavior and a balance of object types.
+    13. current_time_index - 
+        The index into timestamps_seconds for the current time. All steps before this index are history data 
+        and all steps after this index are future data. Predictions are to be made at the current time.
+    14. compressed_frame_laser_data - 
+        Repeated fields containing per time step Lidar data. This contains lidar data up to the current time
+        step (first 1 second) for each segment. Note that this field is only populated in the lidar data 
+        split of the Motion Dataset.
+    '''
+    scene = dict()
+    scene['id'] = scenario.scenario_id
+    sdc_index = scenario.sdc_track_index
+    scene['all_agent'] = extract_tracks(scenario.tracks, sdc_index)
+
+    scene['traffic_light'] = extract_dynamic(scenario.dynamic_map_states)
+    global SAMPLE_NUM
+    SAMPLE_NUM = 10
+    scene['lane'], scene['center_info'] = extract_map(scenario.map_features)
+
+    SAMPLE_NUM = 10e9
+    scene['unsampled_lane'], _ = extract_map(scenario.map_features)
+
+    compute_width(scene)
+    return scene
+
+
+def parse_file(file_path, part_path):
+    """
+    Parse one tfrecord file in a single streaming pass, the scenarios are saved as part_path/{j}.pkl.
+    Return the number of saved scenarios.
+    """
+    os.makedirs(part_path, exist_ok=True)
     scenario = scenario_pb2.Scenario()
-    file_list = os.listdir(inut_path)
-    for file in tqdm(file_list):
-        file_path = os.path.join(inut_path, file)
-        if not 'tfrecord' in file_path:
+    dataset = tf.data.TFRecordDataset(file_path, compression_type='')
+    cnt = 0
+    for j, data in enumerate(dataset.as_numpy_iterator()):
+        try:
+            scenario.ParseFromString(data)
+            scene = parse_scenario(scenario)
+        except:
+            print(f'fail to parse {j} of {file_path},continue')
             continue
-        dataset = tf.data.TFRecordDataset(file_path, compression_type='')
-        dataset_len = 0
-        for i in dataset.as_numpy_iterator():
-            dataset_len += 1
-
-        for j, data in enumerate(dataset.as_numpy_iterator()):
-            try:
-                if pre_fix == 'None':
-                    p = os.path.join(output_path, '{}.pkl'.format(cnt))
-                else:
-                    p = os.path.join(output_path, '{}_{}.pkl'.format(pre_fix, cnt))
-
-                scenario.ParseFromString(data)
-                '''
-                For param scenario:
-                01. scenario_id - 
-                    A unique string identifier for this scenario.
-                02. timestamps_seconds - 
-                    Repeated field containing timestamps for each step in the Scenario starting at zero.
-                03. tracks - 
-                    Repeated field containing tracks for each object.
-                04. id - 
-                    A unique numeric ID for each object.
-                05. object_type - 
-                    The type of object for this track (vehicle, pedestrian, or cyclist).
-                06. states - 
-                    Repeated field containing the state of the object for each time step containing its 3D position, 
-                    velocity, heading, dimensions, and a valid flag. This field corresponds to the top level 
-                    timestamps_seconds field such that tracks[i].states[j] indexes the ith agent's state at time 
-                    timestamps_seconds[j]
-                07. dynamic_map_states - 
-                    Repeated field containing traffic signal states across time steps such that dynamic_map_states[i] 
-                    occurs at timestamps_seconds[i]
-                08. lane_states - 
-                    Repeated field containing the set of traffic signal states and the IDs of lanes they control 
-                    (indexes into the map_features field) for a given time step.
-                09. map_features - 
-                    Repeated field containing the set of map data for the scenario. This includes lane centers, 
-                    lane boundaries, road boundaries, crosswalks, speed bumps, and stop signs. Map features are 
-                    defined as 3D polylines or polygons. See the map proto definitions for full details.
-                10. sdc_track_index - 
-                    The track index of the autonomous vehicle in the scene.
-                11. objects_of_interest - 
-                    Repeated field containing indices into the tracks field of objects determined to have behavior that 
-                    may be useful for research training.
-                12. tracks_to_predict - 
-                    Repeated field containing a set of indices into the tracks field indicating which objects must be 
-                    predicted. This field is provided in the training and validation sets only. These are selected to 
-                    include interesting behavior and a balance of object types.
-                13. current_time_index - 
-                    The index into timestamps_seconds for the current time. All steps before this index are history data 
-                    and all steps after this index are future data. Predictions are to be made at the current time.
-                14. compressed_frame_laser_data - 
-                    Repeated fields containing per time step Lidar data. This contains lidar data up to the current time
-                    step (first 1 second) for each segment. Note that this field is only populated in the lidar data 
-                    split of the Motion Dataset.
-                '''
-                scene = dict()
-                scene['id'] = scenario.scenario_id
-                sdc_index = scenario.sdc_track_index
-                scene['all_agent'] = extract_tracks(scenario.tracks, sdc_index)
-
-                # ego = scenario.tracks[sdc_index]
-                scene['traffic_light'] = extract_dynamic(scenario.dynamic_map_states)
-                global SAMPLE_NUM
-                SAMPLE_NUM = 10
-                scene['lane'], scene['center_info'] = extract_map(scenario.map_features)
-
-                SAMPLE_NUM = 10e9
-                scene['unsampled_lane'], _ = extract_map(scenario.map_features)
-
-                # time_sample = min(int(len(ego.states) / BATCH_SIZE), TIME_SAMPLE)
-                # sdc_x = np.array([state.center_x for state in ego.states])[::time_sample, ...][:BATCH_SIZE]
-                # sdc_y = np.array([state.center_y for state in ego.states])[::time_sample, ...][:BATCH_SIZE]
-                # sdc_yaw = np.array([state.heading for state in ego.states])[::time_sample, ...][:BATCH_SIZE]
-                # sdc_theta = yaw_to_y(sdc_yaw).astype(np.float32)
-                # pos = np.stack([sdc_x, sdc_y], axis=-1)
-                # scene['sdc_theta'] = sdc_theta
-                # scene['sdc_pos'] = pos
-                compute_width(scene)
-                # scene['lane'], scene['lane_mask'] = transform_coordinate_map(lane, ego)
-                # scene['traf_p_c_f'] = add_traff_to_lane(scene)
-
-            except:
-                print(f'fail to parse {cnt},continue')
-                continue
-            # test
-            with open(p, 'wb') as f:
-                pickle.dump(scene, f)
-
-            cnt += 1
-            if cnt > MAX:
-                break
-        if cnt > MAX:
-            break
-    return
+        with open(os.path.join(part_path, '{}.pkl'.format(cnt)), 'wb') as f:
+            pickle.dump(scene, f)
+        cnt += 1
+    return cnt
+
+
+def parse_file_job(args):
+    """Worker job: parse one file unless its manifest says it is done, then write the manifest."""
+    inut_path, output_path, file = args
+    part_path = os.path.join(output_path, PART_DIR, file)
+    done_path = part_path + '.done'
+    if not os.path.exists(done_path):
+        cnt = parse_file(os.path.join(inut_path, file), part_path)
+        # write the manifest atomically, a crashed worker leaves no manifest and the file is parsed again
+        with open(done_path + '.tmp', 'w') as f:
+            f.write(str(cnt))
+        os.replace(done_path + '.tmp', done_path)
+    return file
+
+
+def merge_parts(file_list, output_path):
+    """
+    Move the parsed scenarios to output_path/{idx}.pkl, numbered contiguously in the order of the sorted file list.
+    The manifests are kept, so calling it again (e.g. after a crash) only moves what is left.
+    """
+    idx = 0
+    for file in file_list:
+        part_path = os.path.join(output_path, PART_DIR, file)
+        with open(part_path + '.done') as f:
+            cnt = int(f.read())
+        for j in range(cnt):
+            src = os.path.join(part_path, '{}.pkl'.format(j))
+            if os.path.exists(src):
+                os.replace(src, os.path.join(output_path, '{}.pkl'.format(idx)))
+            idx += 1
+        if os.path.isdir(part_path):
+            os.rmdir(part_path)
+    return idx
+
+
+def parse_data(inut_path, output_path, num_workers=8):
+    """
+    Convert all tfrecord files in inut_path to scenario pickles in output_path, one worker process per file.
+    Files parsed in a previous run are skipped, so an interrupted conversion resumes by running it again.
+    """
+    file_list = sorted([file for file in os.listdir(inut_path) if 'tfrecord' in file])
+    os.makedirs(os.path.join(output_path, PART_DIR), exist_ok=True)
+    jobs = [(inut_path, output_path, file) for file in file_list]
+
+    if num_workers > 1:
+        # spawn instead of fork, tensorflow is not fork safe
+        with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+            for _ in tqdm(pool.imap_unordered(parse_file_job, jobs), total=len(jobs)):
+                pass
+    else:
+        for job in tqdm(jobs):
+            parse_file_job(job)
+
+    scenario_num = merge_parts(file_list, output_path)
+    print(f'{scenario_num} scenarios from {len(file_list)} files are saved to {output_path}')
+    return scenario_num
 
 
 if __name__ == '__main__':
     """
-    Usage: devide the source data to several pieces, like 10 dirs each containing 100 rf record data, out_put to on dir
-    for x in 10
-        mkdir raw_x
-        move 0-100 raw_x
-    then you put data to 10 dir
-    for x in 10
-        nohup python trans20 ./raw_x ./scenario x > x.log 2>&1 &
-    NOTE: 3 *x* to change when manually repeat !!!!!
-    ```tail -n 100 -f x.log```  to vis progress of process x
-
-    After almost 30 minutes, all cases are stored in dir scenario
-    Then run ```nohup python unify.py scenario > unify.log 2>&1 &``` to unify the name      
-
-    ls -l scenario | wc -l 
-    output: 70542   
+    Usage: python trans20.py RAW_DATA_PATH PROCESSED_DATA_PATH [--num_workers 8]
+
+    Every tfrecord file in RAW_DATA_PATH is parsed by a worker process, the cases are stored in PROCESSED_DATA_PATH
+    as 0.pkl, 1.pkl, ... in the order of the sorted file names. The progress of each file is recorded in
+    PROCESSED_DATA_PATH/.parts, if the conversion is interrupted, run the same command again to resume.
 
     Some data may be broken
     """
-    # raw_data_path = sys.argv[1] or '../data/tf_record/raw'
-    # processed_data_path = sys.argv[2] or '../data/tf_record/process'
-    # pre_fix = sys.argv[3]
-
-    # raw_data_path = ".\\data"
-    # processed_data_path = ".\\debug_data"
-    # pre_fix = str(uuid.uuid4())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('raw_data_path', type=str, nargs='?', default='../data/tf_record/raw')
+    parser.add_argument('processed_data_path', type=str, nargs='?', default='../data/tf_record/process')
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
 
-    raw_data_path = "../data/tf_record/raw"
-    processed_data_path = "../data/tf_record/process"
-    pre_fix = None
     #  parse raw data from input path to output path,
     #  there is 1000 raw data in google cloud, each of them produce about 500 pkl file
-    parse_data(raw_data_path, processed_data_path)
+    parse_data(args.raw_data_path, args.processed_data_path, args.num_workers)
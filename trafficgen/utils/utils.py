@@ -1,10 +1,10 @@
+import contextlib
 import copy
 import os
 import random
 
 import numpy as np
 import torch
-from shapely.geometry import Polygon
 
 
 def setup_seed(seed):
@@ -46,6 +46,132 @@ def cal_rel_dir(dir1, dir2):
     return dist
 
 
+def nearest_vec(point, vectors, vector_mask, max_elements=2**22):
+    """
+    Index of the nearest valid vector (by its middle point) and the distance to it, for points in shape [b, n, 2] and
+    vectors in shape [b, vec_num, >=4]. Invalid vectors are at distance 10e5. The distance matrix is computed in
+    chunks of points, so at most max_elements distances are in memory at the same time.
+    """
+    vec_x = ((vectors[..., 0] + vectors[..., 2]) / 2)[:, np.newaxis]
+    vec_y = ((vectors[..., 1] + vectors[..., 3]) / 2)[:, np.newaxis]
+    invalid = (vector_mask == 0)[:, np.newaxis]
+
+    b, point_num, _ = point.shape
+    vec_num = vectors.shape[1]
+    vec_index = np.zeros([b, point_num], dtype=int)
+    min_dist = np.zeros([b, point_num])
+    step = max(1, max_elements // max(1, b * vec_num))
+    for start in range(0, point_num, step):
+        end = min(start + step, point_num)
+        x = point[:, start:end, 0, np.newaxis]
+        y = point[:, start:end, 1, np.newaxis]
+        dist = np.sqrt((vec_x - x)**2 + (vec_y - y)**2)
+        dist = np.where(invalid, 10e5, dist)
+        index = np.argmin(dist, -1)
+        vec_index[:, start:end] = index
+        min_dist[:, start:end] = np.take_along_axis(dist, index[..., np.newaxis], -1)[..., 0]
+    return vec_index, min_dist
+
+
+def raster_sort(agent, mask):
+    """
+    Sort the agents of every frame on a 0.25m raster, rows from top to bottom and from left to right inside a row.
+    Invalid agents are put at the end. agent is in shape [b, n, dim] and mask in shape [b, n].
+    The order is the same as sorting every frame by rows, then every row by columns, one at a time.
+    """
+    # put invalid agent to the right down side
+    invalid = mask == 0
+    x = np.floor(np.where(invalid, 10e8, agent[..., 0]) / 0.25)
+    y = np.floor(np.where(invalid, -10e8, agent[..., 1]) / 0.25)
+
+    # sort the rows from top to bottom, then inside every row from left to right
+    y_index = np.argsort(-y, axis=-1)
+    x = np.take_along_axis(x, y_index, -1)
+    y = np.take_along_axis(y, y_index, -1)
+    order = np.lexsort((x, -y), axis=-1)
+    index = np.take_along_axis(y_index, order, -1)
+
+    # agents in the same raster cell are ordered by the unstable argsort of their row, do it for those rows only
+    sorted_x = np.take_along_axis(x, order, -1)
+    sorted_y = np.take_along_axis(y, order, -1)
+    same_cell = (sorted_x[:, 1:] == sorted_x[:, :-1]) * (sorted_y[:, 1:] == sorted_y[:, :-1])
+    rows = {(i, sorted_y[i, j]) for i, j in zip(*np.nonzero(same_cell))}
+    for i, row_y in rows:
+        ind = np.nonzero(y[i] == row_y)[0]
+        index[i, ind] = y_index[i, ind][np.argsort(x[i, ind])]
+
+    return np.take_along_axis(agent, index[..., np.newaxis], 1), np.take_along_axis(mask, index, 1)
+
+
+def compact(mask, max_num, *arrays):
+    """
+    Move the valid items of every row to the front, keeping their order, and cut the rows to max_num. arrays are in
+    shape [b, n, ...] and mask in shape [b, n]. Returns the padded arrays and the new mask.
+    """
+    b, n = mask.shape
+    num = min(n, max_num)
+    order = np.argsort(~mask, axis=1, kind='stable')[:, :num]
+    new_mask = np.zeros([b, max_num], dtype=bool)
+    new_mask[:, :num] = np.take_along_axis(mask, order, 1)
+
+    output = []
+    for arr in arrays:
+        new_arr = np.zeros([b, max_num, *arr.shape[2:]], dtype=arr.dtype)
+        new_arr[:, :num] = np.take_along_axis(arr, order.reshape(b, num, *[1] * (arr.ndim - 2)), 1)
+        new_arr[~new_mask] = 0
+        output.append(new_arr)
+    return output, new_mask
+
+
+def box_intersect(box_a, box_b):
+    """
+    Separating axis test between oriented boxes, given by their 4 corners in order like WaymoAgent.get_rect.
+    box_a in shape [n, 4, 2] and box_b in shape [m, 4, 2], returns in shape [n, m] whether the boxes overlap, boxes
+    that only touch overlap like in shapely's intersects.
+    """
+    # the edge directions of the two boxes are the only candidate separating axes
+    axes_a = box_a[:, 1:3] - box_a[:, 0:2]
+    axes_b = box_b[:, 1:3] - box_b[:, 0:2]
+
+    def project(box, axes):
+        # corners of every box onto the axes of every box, in shape [box, axes box, axis, corner]
+        proj = box.reshape(-1, 2) @ axes.reshape(-1, 2).T
+        return proj.reshape(box.shape[0], 4, axes.shape[0], 2).transpose(0, 2, 3, 1)
+
+    own_a = np.einsum('ncd,nkd->nkc', box_a, axes_a)[:, np.newaxis]  # [n, 1, 2, 4]
+    own_b = np.einsum('mcd,mkd->mkc', box_b, axes_b)[np.newaxis]  # [1, m, 2, 4]
+    b_on_a = project(box_b, axes_a).transpose(1, 0, 2, 3)  # [n, m, 2, 4]
+    a_on_b = project(box_a, axes_b)  # [n, m, 2, 4]
+
+    separated_a = (own_a.max(-1) < b_on_a.min(-1)) | (b_on_a.max(-1) < own_a.min(-1))
+    separated_b = (a_on_b.max(-1) < own_b.min(-1)) | (own_b.max(-1) < a_on_b.min(-1))
+    return ~(np.any(separated_a, axis=-1) | np.any(separated_b, axis=-1))
+
+
+def point_in_box(point, box):
+    """Whether the points in shape [n, 2] are inside the oriented boxes in shape [m, 4, 2], in shape [n, m]."""
+    # coordinates along the two edges from the first corner, inside if both are within the edge length
+    rel = point[:, np.newaxis] - box[np.newaxis, :, 0]
+    edge_1 = box[:, 1] - box[:, 0]
+    edge_2 = box[:, 3] - box[:, 0]
+    coord_1 = np.sum(rel * edge_1, axis=-1)
+    coord_2 = np.sum(rel * edge_2, axis=-1)
+    inside_1 = (coord_1 >= 0) & (coord_1 <= np.sum(edge_1**2, axis=-1))
+    inside_2 = (coord_2 >= 0) & (coord_2 <= np.sum(edge_2**2, axis=-1))
+    return inside_1 & inside_2
+
+
+def inference_autocast(device, precision='fp32'):
+    """
+    Context to run inference in precision 'fp32', 'bf16' or 'fp16': matmuls and linear layers are autocast to the
+    reduced type, the models cast the outputs of their heads back to float32.
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+    return torch.autocast(device_type=device, dtype=dtype)
+
+
 def wash(batch):
     for key in batch.keys():
         if batch[key].dtype == np.float64:
@@ -65,33 +191,29 @@ def process_lane(lane, max_vec, lane_range, offset=-40):
 
     lane_point_mask = (abs(lane[..., 0] + offset) < lane_range) * (abs(lane[..., 1]) < lane_range)
 
-    lane_id = np.unique(lane[..., -2]).astype(int)
-
-    vec_list = []
-    vec_mask_list = []
-    b_s, _, lane_dim = lane.shape
-
-    for id in lane_id:
-        id_set = lane[..., -2] == id
-        points = lane[id_set].reshape(b_s, -1, lane_dim)
-        masks = lane_point_mask[id_set].reshape(b_s, -1)
-
-        vector = np.zeros([b_s, points.shape[1] - 1, vec_dim])
-        vector[..., 0:2] = points[:, :-1, :2]
-        vector[..., 2:4] = points[:, 1:, :2]
-        # id
-        # vector[..., 4] = points[:,1:, 3]
-        # type
-        vector[..., 4] = points[:, 1:, 2]
-        # traffic light
-        vector[..., 5] = points[:, 1:, 4]
-        vec_mask = masks[:, :-1] * masks[:, 1:]
-        vector[vec_mask == 0] = 0
-        vec_list.append(vector)
-        vec_mask_list.append(vec_mask)
-
-    vector = np.concatenate(vec_list, axis=1) if vec_list else np.zeros([b_s, 0, vec_dim])
-    vector_mask = np.concatenate(vec_mask_list, axis=1) if vec_mask_list else np.zeros([b_s, 0], dtype=bool)
+    b_s = lane.shape[0]
+
+    # the map is static, so every batch shares the same lane id layout. Group the points of each lane together
+    # (ordered by lane id, keeping the point order inside a lane) and link every two consecutive points of a lane.
+    order = np.argsort(lane[0, :, -2], kind='stable')
+    points = lane[:, order]
+    masks = lane_point_mask[:, order]
+    same_lane = points[0, 1:, -2] == points[0, :-1, -2]
+
+    start_points = points[:, :-1][:, same_lane]
+    end_points = points[:, 1:][:, same_lane]
+
+    vector = np.zeros([b_s, start_points.shape[1], vec_dim])
+    vector[..., 0:2] = start_points[..., :2]
+    vector[..., 2:4] = end_points[..., :2]
+    # id
+    # vector[..., 4] = end_points[..., 3]
+    # type
+    vector[..., 4] = end_points[..., 2]
+    # traffic light
+    vector[..., 5] = end_points[..., 4]
+    vector_mask = (masks[:, :-1] * masks[:, 1:])[:, same_lane]
+    vector[vector_mask == 0] = 0
 
     all_vec = np.zeros([b_s, max_vec, vec_dim])
     all_mask = np.zeros([b_s, max_vec])
@@ -102,38 +224,17 @@ def process_lane(lane, max_vec, lane_range, offset=-40):
         dist = vector_t[..., 0]**2 + vector_t[..., 1]**2
         idx = np.argsort(dist)
         vector_t = vector_t[idx]
-        mask_t = np.ones(vector_t.shape[0])
 
         vector_t = vector_t[:max_vec]
-        mask_t = mask_t[:max_vec]
-
-        vector_t = np.pad(vector_t, ([0, max_vec - vector_t.shape[0]], [0, 0]))
-        mask_t = np.pad(mask_t, ([0, max_vec - mask_t.shape[0]]))
-        all_vec[t] = vector_t
-        all_mask[t] = mask_t
+        valid_num = vector_t.shape[0]
+        all_vec[t, :valid_num] = vector_t
+        all_mask[t, :valid_num] = 1
 
     return all_vec, all_mask.astype(bool)
 
 
-def process_map(lane, traf, center_num=384, edge_num=128, lane_range=60, offest=-40):
-    lane_with_traf = np.zeros([*lane.shape[:-1], 5])
-    lane_with_traf[..., :4] = lane
-
-    lane_id = lane[..., -1]
-    b_s = lane_id.shape[0]
-
-    for i in range(b_s):
-        traf_t = traf[i]
-        lane_id_t = lane_id[i]
-        for a_traf in traf_t:
-            control_lane_id = a_traf[0]
-            state = a_traf[-2]
-            lane_idx = np.where(lane_id_t == control_lane_id)
-            lane_with_traf[i, lane_idx, -1] = state
-
-    # lane = np.delete(lane_with_traf,-2,axis=-1)
-    lane = lane_with_traf
-    lane_type = lane[0, :, 2]
+def split_lane_type(lane_type):
+    """Split the map points into center lanes, boundaries, crosswalks / speed bumps and the rest by their type."""
     center_1 = lane_type == 1
     center_2 = lane_type == 2
     center_3 = lane_type == 3
@@ -156,6 +257,137 @@ def process_map(lane, traf, center_num=384, edge_num=128, lane_range=60, offest=
     cross_ind = cross_walk + speed_bump
 
     rest = ~(center_ind + bound_ind + cross_walk + speed_bump + cross_ind)
+    return center_ind, bound_ind, cross_ind, rest
+
+
+def lane_groups(lane):
+    """
+    The lane vectors of the map (in shape [lane_num, 4]) split into center lines, edges, crosswalks and the rest, the
+    start and end point, type and lane id of every vector of a group, in the same order as process_lane.
+    """
+    groups = []
+    for ind in split_lane_type(lane[:, 2]):
+        # link consecutive points of every lane, in the same order as process_lane
+        points = lane[ind]
+        order = np.argsort(points[:, -1], kind='stable')
+        points = points[order]
+        same_lane = points[1:, -1] == points[:-1, -1]
+        start_points = points[:-1][same_lane]
+        end_points = points[1:][same_lane]
+
+        group = {}
+        group['start'] = start_points[:, :2]
+        group['end'] = end_points[:, :2]
+        group['type'] = end_points[:, 2]
+        group['id'] = end_points[:, 3]
+        groups.append(group)
+    return groups
+
+
+class LaneIndex:
+    """
+    Spatial index over the lane vectors of one scenario. It is built once from the static map (data['lane'] or
+    data['unsampled_lane'], in shape [lane_num, 4]) and answers "the K nearest vectors within range R of pose P".
+    The output is the same as transforming the whole lane array to the ego frame of P and calling process_map.
+    """
+    def __init__(self, lane):
+        from scipy.spatial import cKDTree
+
+        self.groups = lane_groups(lane)
+        for group in self.groups:
+            group['tree'] = cKDTree(group['start']) if group['start'].shape[0] > 0 else None
+
+    def query(self, group_idx, pose, traf, max_vec, lane_range, offset=-40):
+        """
+        Vectors of a group inside the crop window of every pose, sorted by their distance to the pose and cut to
+        max_vec. pose is in shape [b, 3] (x, y, yaw) and traf holds the traffic light of each pose. Same as
+        process_lane on the lane transformed to the ego frame of every pose.
+        """
+        vec_dim = 6
+        b_s = pose.shape[0]
+        all_vec = np.zeros([b_s, max_vec, vec_dim])
+        all_mask = np.zeros([b_s, max_vec])
+
+        group = self.groups[group_idx]
+        if group['tree'] is None:
+            return all_vec, all_mask.astype(bool)
+
+        # the crop window is a square in the ego frame, search the circle around it then check the square exactly
+        center = pose[:, :2]
+        yaw = pose[:, 2]
+        window_center = center - offset * np.stack([np.cos(yaw), np.sin(yaw)], axis=-1)
+        candidate_list = group['tree'].query_ball_point(window_center, r=lane_range * np.sqrt(2) + 1.0)
+        # keep the candidates of each pose in their original order, so ties are sorted the same as process_lane
+        candidate_list = [np.sort(np.array(candidate, dtype=int)) for candidate in candidate_list]
+        row = np.concatenate([np.full(len(candidate), i) for i, candidate in enumerate(candidate_list)])
+        candidate = np.concatenate(candidate_list)
+
+        start = group['start'][candidate] - center[row]
+        start = rotate(start[:, 0], start[:, 1], -yaw[row])
+        end = group['end'][candidate] - center[row]
+        end = rotate(end[:, 0], end[:, 1], -yaw[row])
+
+        start_mask = (abs(start[:, 0] + offset) < lane_range) * (abs(start[:, 1]) < lane_range)
+        end_mask = (abs(end[:, 0] + offset) < lane_range) * (abs(end[:, 1]) < lane_range)
+        vec_mask = start_mask * end_mask
+        candidate = candidate[vec_mask]
+        row = row[vec_mask]
+
+        vector = np.zeros([candidate.shape[0], vec_dim])
+        vector[:, 0:2] = start[vec_mask]
+        vector[:, 2:4] = end[vec_mask]
+        vector[:, 4] = group['type'][candidate]
+        lane_id = group['id'][candidate]
+
+        split = np.searchsorted(row, np.arange(b_s + 1))
+        for t in range(b_s):
+            vector_t = vector[split[t]:split[t + 1]]
+            lane_id_t = lane_id[split[t]:split[t + 1]]
+            for a_traf in traf[t]:
+                vector_t[lane_id_t == a_traf[0], 5] = a_traf[-2]
+
+            dist = vector_t[..., 0]**2 + vector_t[..., 1]**2
+            idx = np.argsort(dist)
+            vector_t = vector_t[idx]
+
+            vector_t = vector_t[:max_vec]
+            valid_num = vector_t.shape[0]
+            all_vec[t, :valid_num] = vector_t
+            all_mask[t, :valid_num] = 1
+
+        return all_vec, all_mask.astype(bool)
+
+    def process_map(self, pose, traf, center_num=384, edge_num=128, lane_range=60, offest=-40):
+        """Same as process_map, for a batch of ego poses in shape [b, 3] (x, y, yaw) with the traffic light of each."""
+        output = []
+        for group_idx, max_vec in enumerate([center_num, edge_num, 32, 192]):
+            output.extend(self.query(group_idx, pose, traf, max_vec, lane_range, offest))
+        return output
+
+
+def process_map(lane, traf, center_num=384, edge_num=128, lane_range=60, offest=-40):
+    lane_with_traf = np.zeros([*lane.shape[:-1], 5])
+    lane_with_traf[..., :4] = lane
+
+    lane_id = lane[..., -1]
+    b_s = lane_id.shape[0]
+
+    for i in range(b_s):
+        traf_t = traf[i]
+        if i > 0 and traf_t is traf[i - 1]:
+            # same traffic light state on the same static map, e.g. a batch of agents at one timestep
+            lane_with_traf[i, :, -1] = lane_with_traf[i - 1, :, -1]
+            continue
+        lane_id_t = lane_id[i]
+        for a_traf in traf_t:
+            control_lane_id = a_traf[0]
+            state = a_traf[-2]
+            lane_idx = np.where(lane_id_t == control_lane_id)
+            lane_with_traf[i, lane_idx, -1] = state
+
+    # lane = np.delete(lane_with_traf,-2,axis=-1)
+    lane = lane_with_traf
+    center_ind, bound_ind, cross_ind, rest = split_lane_type(lane[0, :, 2])
 
     cent, cent_mask = process_lane(lane[:, center_ind], center_num, lane_range, offest)
     bound, bound_mask = process_lane(lane[:, bound_ind], edge_num, lane_range, offest)
@@ -288,6 +520,8 @@ class WaymoAgent:
         return rect_list
 
     def get_polygon(self):
+        from shapely.geometry import Polygon  # only needed here, shapely is slow to import
+
         rect_list = self.get_rect(pad=0.25)
 
         poly_list = []